@@ -0,0 +1,42 @@
+# Пакетное построение карт высот без графического интерфейса.
+# Использование:
+#   python batch.py jobs.jsonl --source lipetsk_high.geojson
+# Каждая строка jobs.jsonl - JSON объект задания, например:
+#   {"left_bottom": [39.444032, 52.466341], "right_top": [39.829939, 52.683001], "step_size": 200,
+#    "column_count": 130, "row_count": 101, "format": "asc", "output": "heightmap.txt"}
+# Необязательные поля: crs (по умолчанию МСК-48), format ('asc', 'flt' или 'npy'), output.
+# Исходный файл загружается и преобразуется в полигоны один раз для объединения областей всех заданий,
+# после чего все задания строятся по этим общим данным.
+
+import argparse
+import time
+from modules import profiling
+from modules.cache import ContourCache
+from modules.jobs import SharedTerrain, read_jobs, run_job
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build heightmaps for many jobs from one contour file.')
+    parser.add_argument('jobs', help='JSONL file with one job per line')
+    parser.add_argument('--source', required=True, help='GeoJSON file with contour lines')
+    parser.add_argument('--cache-dir', help='directory of the projected contours and polygons cache')
+    parser.add_argument('--batch-size', type=int, help='read the source in streamed batches of this many features')
+    parser.add_argument('--plot', action='store_true', help='save a PNG preview next to every heightmap')
+    parser.add_argument('--profile', metavar='REPORT', help='write a per-stage JSON metrics report to this path')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.start()
+
+    jobs = read_jobs(args.jobs)
+    if not jobs:
+        parser.error('no jobs in the jobs file')
+    cache = ContourCache(args.cache_dir) if args.cache_dir else None
+    terrain = SharedTerrain.for_jobs(args.source, jobs, cache, args.batch_size)
+
+    for i, job in enumerate(jobs):
+        started = time.perf_counter()
+        run_job(terrain, job, args.plot)
+        print(f'[{i + 1}/{len(jobs)}] {job.output} ({time.perf_counter() - started:.2f}s)', flush=True)
+
+    if args.profile:
+        profiling.stop(args.profile)
@@ -0,0 +1,204 @@
+# Запуск (из корня репозитория):
+#   python -m benchmarks.run --counts 16,64 --grids 100,400 --output bench.json
+#   python -m benchmarks.run --compare bench_before.json bench.json
+# Каждый этап конвейера измеряется отдельно: время (wall и CPU) и прирост пикового RSS процесса во время этапа (Linux),
+# поэтому учитывается и память, выделенная GEOS и GDAL.
+# Результаты записываются в JSON вместе с коммитом и версиями библиотек, чтобы сравнивать запуски между коммитами.
+
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import geopandas
+import json
+import numpy as np
+import os
+import platform
+import shapely
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable
+from benchmarks import synthetic
+from modules import profiling
+from modules.contours import contours_to_polygons
+from modules.processing import (
+    load_geojson,
+    validate_data,
+    clip_contours,
+    grid_bounds_wgs84,
+    project_geometry,
+    generate_sampling_grid,
+    generate_height_map,
+    MSK_48_CRS,
+)
+from modules.quadtree import quadtree_height_map
+from modules.rasterization import rasterize_height_map
+
+SCENARIOS = ('hills', 'plateaus', 'multipolygons')
+STAGES = ('load_geojson', 'validate_data', 'clip_contours', 'project_geometry', 'contours_to_polygons', 'generate_sampling_grid', 'generate_height_map', 'rasterize_height_map', 'quadtree_height_map')
+
+'''
+    Выполняет func один раз для измерения памяти и ещё repeat раз для измерения времени (берётся минимальное время wall и CPU).
+    Память - прирост пикового RSS процесса во время первого запуска над RSS перед ним (peak_bytes) и сам пиковый RSS (peak_rss_bytes).
+    Перед запуском освобождённая память кучи возвращается системе (malloc_trim), иначе этап мог бы занять её без роста RSS.
+    Если сброс пика RSS недоступен (не Linux), память не измеряется (None).
+    Возвращает результат первого запуска и измерения.
+'''
+def measure(func: Callable, repeat: int) -> tuple[object, dict]:
+    gc.collect()
+    _trim_heap()
+    before = profiling.current_rss()
+    resettable = profiling.reset_peak_rss()
+    result = func()
+    peak = profiling.peak_rss() if resettable else None
+
+    wall, cpu = [], []
+    for _ in range(repeat):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        repeated = func()
+        wall.append(time.perf_counter() - wall_start)
+        cpu.append(time.process_time() - cpu_start)
+        del repeated
+    peak_bytes = peak - before if peak is not None and before is not None else None
+    return result, {'wall_s': min(wall), 'cpu_s': min(cpu), 'peak_bytes': peak_bytes, 'peak_rss_bytes': peak}
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c')) if ctypes.util.find_library('c') else None
+
+def _trim_heap():
+    if _libc is not None and hasattr(_libc, 'malloc_trim'):
+        _libc.malloc_trim(0)
+
+'''
+    Прогоняет этапы конвейера на одном синтетическом наборе контуров и возвращает записи результатов.
+'''
+def run_scenario(scenario: str, count: int, grids: list[int], stages: set[str], repeat: int, workdir: str) -> list[dict]:
+    records = []
+    def record(stage: str, grid: int | None, items: int, metrics: dict):
+        records.append({'scenario': scenario, 'contours': count, 'grid': grid, 'stage': stage, 'items': items, **metrics})
+        print(f'{scenario:>13} {count:>6} {str(grid or "-"):>6} {stage:<24} {metrics["wall_s"]:9.4f}s {_megabytes(metrics["peak_bytes"]):>9}MB', flush=True)
+
+    if scenario == 'multipolygons':
+        df_polygons = synthetic.multipolygon_terrain(count)
+    else:
+        df_contours = synthetic.nested_hills(count) if scenario == 'hills' else synthetic.plateaus_with_holes(count)
+        #Этапы загрузки работают с WGS84, поэтому набор сохраняется в GeoJSON так же, как исходные данные
+        path = os.path.join(workdir, f'{scenario}_{count}.geojson')
+        df_wgs84 = df_contours.to_crs('EPSG:4326')
+        df_wgs84.to_file(path, driver='GeoJSON')
+        min_x, min_y, max_x, max_y = df_wgs84.total_bounds
+        left_bottom, right_top = (min_x, min_y), (max_x, max_y)
+
+        if 'load_geojson' in stages:
+            df_culled, metrics = measure(lambda: load_geojson(path, left_bottom, right_top), repeat)
+            record('load_geojson', None, len(df_culled), metrics)
+        else:
+            df_culled = load_geojson(path, left_bottom, right_top)
+        if 'validate_data' in stages:
+            _, metrics = measure(lambda: validate_data(df_culled), repeat)
+            record('validate_data', None, len(df_culled), metrics)
+        if 'clip_contours' in stages:
+            #Обрезка по центральной области в четверть площади набора (сетка 100 x 100 с запасом 100 метров)
+            min_x, min_y, max_x, max_y = df_contours.total_bounds
+            step = max(int(np.ceil(max(max_x - min_x, max_y - min_y) / 200)), 1)
+            bounds = grid_bounds_wgs84((int((3*min_x + max_x)/4), int((3*min_y + max_y)/4)), step, 100, 100, MSK_48_CRS, 100)
+            df_clipped, metrics = measure(lambda: clip_contours(df_culled, *bounds), repeat)
+            record('clip_contours', None, len(df_clipped), metrics)
+        if 'project_geometry' in stages:
+            df_projected, metrics = measure(lambda: project_geometry(df_culled, MSK_48_CRS), repeat)
+            record('project_geometry', None, len(df_projected), metrics)
+        else:
+            df_projected = project_geometry(df_culled, MSK_48_CRS)
+        if 'contours_to_polygons' in stages:
+            df_polygons, metrics = measure(lambda: contours_to_polygons(df_projected), repeat)
+            record('contours_to_polygons', None, len(df_polygons), metrics)
+        else:
+            df_polygons = contours_to_polygons(df_projected)
+
+    min_x, min_y, max_x, max_y = synthetic.extent(df_polygons)
+    for grid in grids:
+        #Квадратная сетка grid x grid, покрывающая весь набор
+        step = max(int(np.ceil(max(max_x - min_x, max_y - min_y) / grid)), 1)
+        arguments = ((min_x, min_y), step, grid, grid, MSK_48_CRS)
+        sampling_grid = None
+        if 'generate_sampling_grid' in stages or 'generate_height_map' in stages:
+            sampling_grid, metrics = measure(lambda: generate_sampling_grid(*arguments), repeat)
+            if 'generate_sampling_grid' in stages:
+                record('generate_sampling_grid', grid, grid*grid, metrics)
+        if 'generate_height_map' in stages:
+            _, metrics = measure(lambda: generate_height_map(df_polygons, sampling_grid), repeat)
+            record('generate_height_map', grid, grid*grid, metrics)
+        if 'rasterize_height_map' in stages:
+            _, metrics = measure(lambda: rasterize_height_map(df_polygons, *arguments), repeat)
+            record('rasterize_height_map', grid, grid*grid, metrics)
+        if 'quadtree_height_map' in stages:
+            _, metrics = measure(lambda: quadtree_height_map(df_polygons, *arguments), repeat)
+            record('quadtree_height_map', grid, grid*grid, metrics)
+    return records
+
+'''
+    Сведения о запуске: коммит, время и версии библиотек.
+'''
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'shapely': shapely.__version__,
+        'geopandas': geopandas.__version__,
+    }
+
+'''
+    Печатает отношение времени этапов запуска after к запуску before (меньше 1 - быстрее).
+'''
+def compare(before_path: str, after_path: str):
+    with open(before_path, encoding='utf-8') as file:
+        before = json.load(file)
+    with open(after_path, encoding='utf-8') as file:
+        after = json.load(file)
+    key = lambda record: (record['scenario'], record['contours'], record['grid'], record['stage'])
+    baseline = {key(record): record for record in before['results']}
+    print(f'{before["environment"]["commit"]} -> {after["environment"]["commit"]}')
+    for record in after['results']:
+        old = baseline.get(key(record))
+        if old is None:
+            continue
+        print(f'{record["scenario"]:>13} {record["contours"]:>6} {str(record["grid"] or "-"):>6} {record["stage"]:<24} '
+              f'time x{record["wall_s"]/max(old["wall_s"], 1e-9):6.2f}  memory {_ratio(record["peak_bytes"], old["peak_bytes"])}')
+
+def _megabytes(value: int | None) -> str:
+    return '-' if value is None else f'{value/2**20:.1f}'
+
+def _ratio(after: int | None, before: int | None) -> str:
+    return '-' if after is None or before is None else f'x{after/max(before, 1):6.2f}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the heightmap pipeline stages on synthetic contours.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated scenarios: ' + ', '.join(SCENARIOS))
+    parser.add_argument('--counts', default='16,64', help='comma-separated numbers of hills/plateaus')
+    parser.add_argument('--grids', default='100,400', help='comma-separated grid sizes (cells per side)')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma-separated stages to measure')
+    parser.add_argument('--repeat', type=int, default=1, help='repetitions per stage (minimum time is reported)')
+    parser.add_argument('--output', default='bench_results.json', help='path of the JSON results file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two results files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        stages = set(args.stages.split(','))
+        results = []
+        with tempfile.TemporaryDirectory() as workdir:
+            for scenario in args.scenarios.split(','):
+                for count in map(int, args.counts.split(',')):
+                    results.extend(run_scenario(scenario, count, list(map(int, args.grids.split(','))), stages, args.repeat, workdir))
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump({'environment': environment(), 'results': results}, file, indent=2)
+        print(f'Results written to {args.output}')
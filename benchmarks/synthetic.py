@@ -0,0 +1,103 @@
+import geopandas
+import numpy as np
+import shapely
+from shapely.geometry import LineString, MultiPolygon, Polygon
+from modules.processing import MSK_48_CRS
+
+#Левый нижний угол области синтетических данных в МСК-48 (район данных contours.geojson)
+ORIGIN : tuple[float, float] = (1300000, 380000)
+
+'''
+    Генерирует холмы из вложенных замкнутых контуров.
+    Центры холмов лежат на сетке со случайным смещением, поэтому холмы не пересекаются, а контуры одного холма имеют общую форму
+    разного масштаба и вложены друг в друга.
+    Аргументы:
+        hill_count : int - число холмов.
+        levels : int - число контуров в каждом холме.
+        radius : float - радиус внешнего контура холма в метрах.
+        vertices : int - число вершин каждого контура.
+        base_elevation : float - высота внешнего контура.
+        interval : float - шаг высоты между соседними контурами.
+        seed : int - зерно генератора случайных чисел.
+    Возвращает:
+        geopandas.GeoDataFrame - контуры (LineString) с колонкой elevation в МСК-48.
+'''
+def nested_hills(hill_count: int, levels: int = 5, radius: float = 2000, vertices: int = 64, base_elevation: float = 100, interval: float = 25, seed: int = 0) -> geopandas.GeoDataFrame:
+    rows = [{'elevation': base_elevation + level*interval, 'geometry': ring}
+            for hill in _hills(hill_count, levels, radius, vertices, seed)
+            for level, ring in enumerate(hill)]
+    return geopandas.GeoDataFrame(rows, geometry='geometry', crs=MSK_48_CRS)
+
+'''
+    Генерирует плато с впадинами: внешний контур плато и вложенные в него контуры с убывающей высотой,
+    из которых contours_to_polygons делает дыры.
+    Аргументы совпадают с nested_hills; levels - число контуров впадины внутри каждого плато.
+'''
+def plateaus_with_holes(plateau_count: int, levels: int = 3, radius: float = 2000, vertices: int = 64, base_elevation: float = 200, interval: float = 25, seed: int = 0) -> geopandas.GeoDataFrame:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for center in _hill_centers(plateau_count, radius, rng):
+        rows.append({'elevation': base_elevation, 'geometry': _ring(center, radius, _ring_shape(vertices, rng))})
+        #Впадина смещена от центра плато, но целиком лежит внутри него
+        pit_center = center + rng.uniform(-0.2, 0.2, 2)*radius
+        shape = _ring_shape(vertices, rng)
+        for level in range(1, levels + 1):
+            rows.append({'elevation': base_elevation - level*interval, 'geometry': _ring(pit_center, radius*0.6*(1 - (level - 1)/levels), shape)})
+    return geopandas.GeoDataFrame(rows, geometry='geometry', crs=MSK_48_CRS)
+
+'''
+    Генерирует готовые полигоны высот в виде, аналогичном contours.geojson: по одному MultiPolygon (с дырами) на каждую высоту.
+    Подходит как вход generate_height_map и rasterize_height_map без этапа contours_to_polygons.
+'''
+def multipolygon_terrain(hill_count: int, levels: int = 5, radius: float = 2000, vertices: int = 64, base_elevation: float = 100, interval: float = 25, seed: int = 0) -> geopandas.GeoDataFrame:
+    polygons : list[list[Polygon]] = [[] for _ in range(levels)]
+    for hill in _hills(hill_count, levels, radius, vertices, seed):
+        #Полигон высоты - кольцо между контуром и следующим (более высоким) контуром того же холма
+        for level, ring in enumerate(hill):
+            holes = [hill[level + 1].coords] if level + 1 < levels else []
+            polygons[level].append(Polygon(ring.coords, holes))
+    rows = [{'elevation': base_elevation + level*interval, 'geometry': MultiPolygon(parts)} for level, parts in enumerate(polygons)]
+    return geopandas.GeoDataFrame(rows, geometry='geometry', crs=MSK_48_CRS)
+
+'''
+    Возвращает ограничивающий прямоугольник данных (min_x, min_y, max_x, max_y), округлённый наружу до целых метров.
+'''
+def extent(df: geopandas.GeoDataFrame) -> tuple[int, int, int, int]:
+    min_x, min_y, max_x, max_y = df.total_bounds
+    return int(np.floor(min_x)), int(np.floor(min_y)), int(np.ceil(max_x)), int(np.ceil(max_y))
+
+'''
+    Контуры холмов: для каждого холма - список вложенных колец от внешнего к внутреннему.
+'''
+def _hills(hill_count: int, levels: int, radius: float, vertices: int, seed: int) -> list[list[LineString]]:
+    rng = np.random.default_rng(seed)
+    hills = []
+    for center in _hill_centers(hill_count, radius, rng):
+        shape = _ring_shape(vertices, rng)
+        hills.append([_ring(center, radius*(1 - level/levels), shape) for level in range(levels)])
+    return hills
+
+def _hill_centers(count: int, radius: float, rng: np.random.Generator) -> list[np.ndarray]:
+    side = int(np.ceil(np.sqrt(count)))
+    spacing = radius*2.5
+    centers = []
+    for i in range(count):
+        cell = np.array([i % side, i // side], dtype=np.float64)
+        jitter = rng.uniform(-0.2, 0.2, 2)*radius
+        centers.append(np.array(ORIGIN) + (cell + 0.5)*spacing + jitter)
+    return centers
+
+'''
+    Случайная звёздная форма контура: множитель радиуса для каждого угла. Одна форма разного масштаба даёт вложенные кольца.
+'''
+def _ring_shape(vertices: int, rng: np.random.Generator) -> np.ndarray:
+    angles = np.linspace(0, 2*np.pi, vertices, endpoint=False)
+    scale = np.ones(vertices)
+    for harmonic in (2, 3, 5):
+        scale += rng.uniform(0, 0.1)*np.sin(harmonic*angles + rng.uniform(0, 2*np.pi))
+    return scale
+
+def _ring(center: np.ndarray, radius: float, shape: np.ndarray) -> LineString:
+    angles = np.linspace(0, 2*np.pi, len(shape), endpoint=False)
+    coords = np.column_stack((center[0] + radius*shape*np.cos(angles), center[1] + radius*shape*np.sin(angles)))
+    return shapely.linestrings(np.vstack((coords, coords[:1])))
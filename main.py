@@ -1,21 +1,49 @@
 # Использование:
 # 1. Задайте нужную область, изменив координаты `left_bottom` и `right_top`.
 # 2. При необходимости, отрегулируйте шаг сэмплирования (`step_size`).
-# 3. Запустите скрипт.
-# 4. Результирующая карта высот будет сохранена в файл `heightmap_**.txt` в том же каталоге.
+# 3. Выберите способ сэмплирования (`backend`): 'sjoin' - пространственное объединение точек сетки с полигонами,
+#    'raster' - прямое заполнение массива высот полигонами (быстрее и требует меньше памяти на больших сетках),
+#    'tiled' - то же, что 'raster', но сетка обрабатывается тайлами (`tile_size`) в нескольких процессах (`workers`),
+#    для больших областей, 'quadtree' - адаптивное сэмплирование: блоки ячеек вдали от контуров заполняются целиком,
+#    а по отдельным ячейкам проверяются только блоки, через которые проходят границы полигонов.
+# 4. Запустите скрипт.
+# 5. Результирующая карта высот будет сохранена в файл `heightmap_**` в том же каталоге в формате `output_format`:
+#    'asc' - ESRI ASCII grid (.txt), 'flt' - бинарный float32 (.flt с заголовком .hdr), 'npy' - массив NumPy (.npy).
+# 6. При `profile = True` рядом с картой высот сохраняется отчёт `heightmap_**.profile.json` о времени, памяти и числе элементов
+#    каждого этапа, а при `profile_cprofile = True` - ещё и статистика cProfile (`heightmap_**.profile.prof`).
+# 7. При `incremental = True` рядом с картой высот сохраняется манифест фитч исходного файла: к имени файла карты высот
+#    добавляется `.manifest.npz` (например, `heightmap_**.txt.manifest.npz`). После небольших правок исходного файла
+#    карту высот можно обновить, пересчитав только затронутые ячейки:
+#    python update.py heightmap_**.txt.manifest.npz
+# 8. Для больших файлов задайте `clip_margin`: контуры обрезаются по области сетки с этим запасом до проецирования,
+#    и время проецирования и построения полигонов зависит от размера области, а не от размера файла.
+#    Вместе с `cache_dir` область обрезки расширяется до клеток по 10 км, и запись кэша используется повторно,
+#    пока сетка с запасом не выходит за эти клетки.
 
 import geopandas as gpd
-import matplotlib.pyplot as plt
+import os
+import time
+from modules import profiling
 from modules.contours import contours_to_polygons
+from modules.quadtree import quadtree_height_map
+from modules.rasterization import rasterize_height_map
+from modules.tiling import generate_height_map_tiled
+from modules.cache import ContourCache, load_polygons_cached
+from modules.incremental import write_manifest
+from modules.streaming import load_projected_streamed
+from modules.writers import OUTPUT_EXTENSIONS, write_height_map
 from modules.processing import (
     load_geojson,
     validate_data,
+    clip_and_project,
+    grid_clip_bounds,
     project_geometry,
     generate_sampling_grid,
     generate_height_map,
     MSK_48_CRS,
     wgs84_point_to_crs,
-    height_map_to_lists,
+    height_map_to_array,
+    GridGeoreference,
 )
 
 if __name__ == "__main__":
@@ -28,61 +56,142 @@ if __name__ == "__main__":
     row_count = 101  # Количество строк в сетке
     target_crs = MSK_48_CRS # Координатная системая для семплирования
     visualize = True
+    backend = 'raster' # Способ сэмплирования: 'sjoin', 'raster', 'tiled' или 'quadtree'
+    tile_size = 512 # Размер стороны тайла в ячейках (для backend = 'tiled')
+    workers = None # Число процессов (для backend = 'tiled'), None - по числу ядер
+    cache_dir = None # Каталог кэша спроецированных контуров и полигонов (например, '.contour_cache'), None - без кэша
+    output_format = 'asc' # Формат файла карты высот: 'asc', 'flt' или 'npy'
+    batch_size = None # Размер пакета фитч при потоковом чтении файла (ограничивает память на разбор файла размером пакета, чтение не обязательно быстрее), None - чтение файла целиком через geopandas
+    profile = False # Записать отчёт о времени, памяти и числе элементов этапов
+    profile_cprofile = False # Дополнительно записать статистику cProfile (при profile = True)
+    incremental = False # Сохранить манифест фитч для последующего обновления карты высот скриптом update.py
+    clip_margin = None # Запас (в метрах) при обрезке контуров по области сетки перед проецированием, None - без обрезки (не используется при backend = 'tiled', который загружает контуры по тайлам)
+    output_path = f'heightmap_{step_size}m_{column_count}c_{row_count}r{OUTPUT_EXTENSIONS[output_format]}'
     
+    started = time.perf_counter()
+    if profile:
+        profiling.start(profile_cprofile)
+
     # Задаем координаты левого нижнего и правого верхнего углов области интереса
     left_bottom_projected = wgs84_point_to_crs(left_bottom, target_crs)
     right_top_projected = wgs84_point_to_crs(right_top, target_crs)
 
-    # Загружаем и валидируем данные в заданной области
-    df_culled = load_geojson(geojson_file, left_bottom, right_top)
-    validate_data(df_culled)
-
-    # Преобразуем контуры в полигоны и проецируем в целевую систему координат
-    df_projected = project_geometry(df_culled, target_crs)
-    df_polygons = contours_to_polygons(df_projected)
-
-    # Генерируем сетку сэмплирования
-    sampling_grid = generate_sampling_grid(
-        leftBottom=(int(left_bottom_projected[0]), int(left_bottom_projected[1])),  # Координаты левого верхнего угла сетки
-        stepSize=step_size,  # Шаг сэмплирования (расстояние между точками)
-        columnCount=column_count,  # Количество столбцов в сетке
-        rowCount=row_count,  # Количество строк в сетке
-        crs=target_crs,  # Система координат сетки
-    )
-
-    # Присваиваем высоты точкам сетки
-    heightmap = generate_height_map(df_polygons, sampling_grid)
-
-    # Получаем карту высот в виде списка списков
-    height_lists = height_map_to_lists(heightmap)
-
-    # Открываем файл для записи
-    with open(f'heightmap_{step_size}m_{column_count}c_{row_count}r.txt', 'w', encoding='utf-8') as file:
-        # Записываем метаданные
-        file.write(f"ncols {column_count}\n")
-        file.write(f"nrows {row_count}\n")
-        file.write(f"xllcorner {int(left_bottom_projected[0])}\n")
-        file.write(f"yllcorner {int(left_bottom_projected[1])}\n")
-        file.write(f"cellsize {step_size}\n")
-        file.write("NODATA_value -99999     Unit μg/m3\n")
-
-        # Записываем данные карты высот
-        for row in height_lists:
-            file.write(' '.join(map(str, row)) + '\n')
-
-    # Визуализируем данные
-    fig, axes = plt.subplots(1, 3, figsize=(15, 5))
+    # Область обрезки контуров: область сетки с запасом, чтобы не проецировать вершины вдали от неё
+    clip_bounds = None
+    if clip_margin is not None:
+        clip_bounds = grid_clip_bounds((int(left_bottom_projected[0]), int(left_bottom_projected[1])), step_size, column_count, row_count, target_crs, clip_margin)
+
+    if backend == 'tiled':
+        # Обрабатываем сетку тайлами в нескольких процессах
+        heightmap, georeference = generate_height_map_tiled(
+            geojson_file,
+            left_bottom,
+            right_top,
+            leftBottom=(int(left_bottom_projected[0]), int(left_bottom_projected[1])),
+            stepSize=step_size,
+            columnCount=column_count,
+            rowCount=row_count,
+            crs=target_crs,
+            tileSize=tile_size,
+            workers=workers,
+        )
+        heights = heightmap
+    else:
+        if cache_dir:
+            # Берём спроецированные контуры и полигоны из кэша (или строим и сохраняем их при первом запуске)
+            df_projected, df_polygons = load_polygons_cached(ContourCache(cache_dir), geojson_file, left_bottom, right_top, target_crs, batch_size, clip_bounds)
+            df_culled = df_projected
+        elif batch_size:
+            # Читаем, валидируем и проецируем данные пакетами, не загружая файл целиком
+            df_projected = load_projected_streamed(geojson_file, left_bottom, right_top, target_crs, batch_size, clip_bounds)
+            df_culled = df_projected
+            df_polygons = contours_to_polygons(df_projected)
+        else:
+            # Загружаем и валидируем данные в заданной области
+            df_culled = load_geojson(geojson_file, left_bottom, right_top)
+            validate_data(df_culled)
+
+            # Проецируем контуры в целевую систему координат, обрезая их по области сетки с запасом
+            if clip_bounds is None:
+                df_projected = project_geometry(df_culled, target_crs)
+            else:
+                df_projected = clip_and_project(df_culled, clip_bounds, target_crs)
+
+            # Преобразуем контуры в полигоны
+            df_polygons = contours_to_polygons(df_projected)
+
+        if backend == 'raster':
+            # Заполняем массив высот напрямую полигонами
+            heightmap, georeference = rasterize_height_map(
+                df_polygons,
+                leftBottom=(int(left_bottom_projected[0]), int(left_bottom_projected[1])),
+                stepSize=step_size,
+                columnCount=column_count,
+                rowCount=row_count,
+                crs=target_crs,
+            )
+            heights = heightmap
+        elif backend == 'quadtree':
+            # Заполняем массив высот блоками, уточняя только блоки на границах полигонов
+            heightmap, georeference = quadtree_height_map(
+                df_polygons,
+                leftBottom=(int(left_bottom_projected[0]), int(left_bottom_projected[1])),
+                stepSize=step_size,
+                columnCount=column_count,
+                rowCount=row_count,
+                crs=target_crs,
+            )
+            heights = heightmap
+        else:
+            # Генерируем сетку сэмплирования
+            sampling_grid = generate_sampling_grid(
+                leftBottom=(int(left_bottom_projected[0]), int(left_bottom_projected[1])),  # Координаты левого верхнего угла сетки
+                stepSize=step_size,  # Шаг сэмплирования (расстояние между точками)
+                columnCount=column_count,  # Количество столбцов в сетке
+                rowCount=row_count,  # Количество строк в сетке
+                crs=target_crs,  # Система координат сетки
+            )
+
+            # Присваиваем высоты точкам сетки
+            heightmap = generate_height_map(df_polygons, sampling_grid)
 
+            # Получаем карту высот в виде двумерного массива
+            heights = height_map_to_array(heightmap)
+            georeference = GridGeoreference((int(left_bottom_projected[0]), int(left_bottom_projected[1])), step_size, column_count, row_count, target_crs)
+
+    # Записываем карту высот в файл
+    write_height_map(output_path, heights, georeference, output_format)
+
+    if incremental:
+        # Запоминаем фитчи исходного файла и длительность полного построения
+        write_manifest(geojson_file, left_bottom, right_top, georeference, output_path, output_format, time.perf_counter() - started)
+
+    if profile:
+        profiling.stop(f'{os.path.splitext(output_path)[0]}.profile.json')
+
+    # Визуализируем данные (matplotlib загружается только при необходимости, чтобы скрипт работал без дисплея)
     if visualize:
-        df_culled.plot(column="elevation", ax=axes[0], legend=True)
-        axes[0].set_title("Исходные данные")
+        import matplotlib.pyplot as plt
+
+        fig, axes = plt.subplots(1, 3, figsize=(15, 5))
+
+        # В режиме тайлов исходные данные и полигоны целиком не загружаются
+        if backend != 'tiled':
+            df_culled.plot(column="elevation", ax=axes[0], legend=True)
+            axes[0].set_title("Исходные данные")
 
-        df_polygons.plot(column="elevation", ax=axes[1], legend=True)
-        axes[1].set_title("Полигоны из контуров")
+            df_polygons.plot(column="elevation", ax=axes[1], legend=True)
+            axes[1].set_title("Полигоны из контуров")
 
-        heightmap.plot(column="elevation", ax=axes[2], legend=True)
-        sampling_grid.boundary.plot(ax=axes[2], color='red', linewidth=0.5)  # Визуализация границ сетки сэмплирования
+        if backend in ('raster', 'tiled', 'quadtree'):
+            extent = (georeference.left_bottom[0], georeference.left_bottom[0] + step_size*column_count,
+                      georeference.left_bottom[1], georeference.left_bottom[1] + step_size*row_count)
+            image = axes[2].imshow(heightmap, extent=extent)
+            fig.colorbar(image, ax=axes[2])
+        else:
+            heightmap.plot(column="elevation", ax=axes[2], legend=True)
+            sampling_grid.boundary.plot(ax=axes[2], color='red', linewidth=0.5)  # Визуализация границ сетки сэмплирования
         axes[2].set_title("Карта высот")
 
-    plt.tight_layout()
-    plt.show()
+        plt.tight_layout()
+        plt.show()
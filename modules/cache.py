@@ -0,0 +1,199 @@
+import geopandas
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import shapely
+import tempfile
+from modules import profiling
+from typing import Final
+from modules.contours import contours_to_polygons
+from modules.processing import ClipBounds, area_clip_bounds, load_geojson, validate_data, clip_and_project, project_geometry
+from modules.streaming import load_projected_streamed
+
+#Версия алгоритма построения полигонов. Входит в ключ кэша, поэтому её нужно увеличивать при изменении contours_to_polygons.
+ALGORITHM_VERSION : Final[int] = 1
+#Шаг решётки (в единицах целевой CRS), к которой расширяется область обрезки контуров перед сохранением в кэш
+CLIP_LATTICE : Final[float] = 10000
+
+'''
+    Дисковый кэш спроецированных контуров и полигонов высот.
+    Ключ записи вычисляется по содержимому исходного файла (sha256), региону загрузки, области обрезки контуров, целевой CRS и ALGORITHM_VERSION,
+    поэтому запуски, отличающиеся только параметрами сетки, используют одну запись. Область обрезки для этого расширяется до решётки
+    с шагом CLIP_LATTICE (см. load_polygons_cached) и меняется, только если сетка с запасом выходит за прежние клетки решётки.
+    Каждая запись - каталог с массивами .npy (WKB геометрий одним буфером, смещения и высоты), которые загружаются через memmap.
+    При превышении size_limit удаляются записи, к которым дольше всего не обращались.
+    Аргументы конструктора:
+        directory : str - каталог кэша.
+        size_limit : int - максимальный суммарный размер записей в байтах.
+'''
+class ContourCache:
+    def __init__(self, directory: str = '.contour_cache', size_limit: int = 2*1024**3):
+        self.directory = directory
+        self.size_limit = size_limit
+        os.makedirs(directory, exist_ok=True)
+
+    '''
+        Вычисляет ключ записи для файла path, региона загрузки left_bottom/right_top (как в load_geojson), CRS crs
+        и области обрезки контуров clip_bounds (как в load_polygons_cached).
+    '''
+    def key(self, path: str, left_bottom: tuple[float, float] | None, right_top: tuple[float, float] | None, crs: str,
+            clip_bounds: ClipBounds | None = None) -> str:
+        bbox = [*left_bottom, *right_top] if left_bottom and right_top else None
+        description = [self._file_digest(path), bbox, crs, ALGORITHM_VERSION]
+        #Область обрезки добавляется только при её наличии, чтобы ключи записей без обрезки не менялись
+        if clip_bounds is not None:
+            description.append([*clip_bounds.wgs84[0], *clip_bounds.wgs84[1], *clip_bounds.projected[0], *clip_bounds.projected[1]])
+        return hashlib.sha256(json.dumps(description).encode('utf-8')).hexdigest()
+
+    '''
+        Загружает запись с ключом key.
+        Возвращает:
+            tuple[geopandas.GeoDataFrame, geopandas.GeoDataFrame] | None - спроецированные контуры и полигоны высот (колонки elevation и geometry)
+                                                                           или None, если записи нет.
+    '''
+    def load(self, key: str) -> tuple[geopandas.GeoDataFrame, geopandas.GeoDataFrame] | None:
+        entry = os.path.join(self.directory, key)
+        meta_path = os.path.join(entry, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding='utf-8') as file:
+            meta = json.load(file)
+        #Время изменения meta.json служит временем последнего обращения к записи
+        os.utime(meta_path)
+        return self._read_frame(entry, 'projected', meta['crs']), self._read_frame(entry, 'polygons', meta['crs'])
+
+    '''
+        Сохраняет спроецированные контуры projected и полигоны polygons под ключом key и освобождает место в кэше при необходимости.
+    '''
+    def store(self, key: str, projected: geopandas.GeoDataFrame, polygons: geopandas.GeoDataFrame):
+        entry = os.path.join(self.directory, key)
+        #Записи с одним ключом одинаковы, поэтому запись, уже сохранённая параллельным запуском, не перезаписывается
+        if os.path.isdir(entry):
+            self.evict()
+            return
+        #Запись собирается во временном каталоге и переименовывается целиком, чтобы прерванный запуск не оставил неполную запись
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.staging-')
+        try:
+            self._write_frame(staging, 'projected', projected)
+            self._write_frame(staging, 'polygons', polygons)
+            with open(os.path.join(staging, 'meta.json'), 'w', encoding='utf-8') as file:
+                json.dump({'crs': projected.crs.to_wkt() if projected.crs else None, 'algorithm_version': ALGORITHM_VERSION}, file)
+            try:
+                os.replace(staging, entry)
+            except OSError:
+                #Параллельный запуск успел сохранить запись с тем же ключом (переименование в непустой каталог не удаётся)
+                if not os.path.isdir(entry):
+                    raise
+                shutil.rmtree(staging, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.evict()
+
+    '''
+        Удаляет записи, начиная с давно не использовавшихся, пока суммарный размер кэша превышает size_limit.
+    '''
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            meta_path = os.path.join(entry, 'meta.json')
+            if not os.path.isdir(entry) or not os.path.exists(meta_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+            entries.append((os.path.getmtime(meta_path), size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.size_limit:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    '''
+        Возвращает sha256 содержимого файла. Результат запоминается по (размер, время изменения) файла, чтобы не хэшировать файл при каждом запуске.
+    '''
+    def _file_digest(self, path: str) -> str:
+        stat = os.stat(path)
+        index_path = os.path.join(self.directory, 'digests.json')
+        index = {}
+        if os.path.exists(index_path):
+            with open(index_path, encoding='utf-8') as file:
+                index = json.load(file)
+        remembered = index.get(os.path.abspath(path))
+        if remembered and remembered[0] == stat.st_size and remembered[1] == stat.st_mtime_ns:
+            return remembered[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        index[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        #Индекс заменяется целиком, чтобы параллельный запуск не прочитал наполовину записанный файл
+        handle, staging = tempfile.mkstemp(dir=self.directory, prefix='.digests-', suffix='.json')
+        try:
+            with os.fdopen(handle, 'w', encoding='utf-8') as file:
+                json.dump(index, file)
+            os.replace(staging, index_path)
+        except BaseException:
+            os.unlink(staging)
+            raise
+        return digest.hexdigest()
+
+    def _write_frame(self, entry: str, name: str, df: geopandas.GeoDataFrame):
+        wkb = shapely.to_wkb(df.geometry.to_numpy())
+        lengths = np.fromiter((len(item) for item in wkb), dtype=np.int64, count=len(wkb))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        np.save(os.path.join(entry, f'{name}_wkb.npy'), np.frombuffer(b''.join(wkb), dtype=np.uint8))
+        np.save(os.path.join(entry, f'{name}_offsets.npy'), offsets)
+        np.save(os.path.join(entry, f'{name}_elevation.npy'), df['elevation'].to_numpy(dtype=np.float64))
+
+    def _read_frame(self, entry: str, name: str, crs: str | None) -> geopandas.GeoDataFrame:
+        buffer = np.load(os.path.join(entry, f'{name}_wkb.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(entry, f'{name}_offsets.npy'))
+        elevation = np.load(os.path.join(entry, f'{name}_elevation.npy'))
+        geometries = shapely.from_wkb([buffer[start:end].tobytes() for start, end in zip(offsets[:-1], offsets[1:])])
+        return geopandas.GeoDataFrame({'elevation': elevation, 'geometry': geometries}, crs=crs)
+
+'''
+    Загружает, валидирует и проецирует контуры из файла path и строит по ним полигоны высот, используя кэш cache.
+    При попадании в кэш файл не читается, а полигоны не перестраиваются.
+    Аргументы совпадают с load_geojson и project_geometry.
+    Если задан batch_size, при промахе файл читается потоково пакетами такого размера (см. load_projected_streamed).
+    Если задан clip_bounds, контуры обрезаются по области clip_bounds.projected, расширенной до решётки с шагом CLIP_LATTICE (см. clip_and_project).
+    Расширенная область входит в ключ записи, поэтому запись используется и для других сеток, лежащих с запасом в той же области.
+    Полигоны обрезанной записи совпадают с полигонами без обрезки внутри clip_bounds.projected.
+    Возвращает:
+        tuple[geopandas.GeoDataFrame, geopandas.GeoDataFrame] - спроецированные контуры и полигоны высот.
+'''
+@profiling.stage('load_polygons_cached', lambda result: {'features': len(result[0]), 'polygons': len(result[1])})
+def load_polygons_cached(cache: ContourCache, path: str, left_bottom: tuple[float, float] | None, right_top: tuple[float, float] | None, crs: str, batch_size: int | None = None,
+                         clip_bounds: ClipBounds | None = None) -> tuple[geopandas.GeoDataFrame, geopandas.GeoDataFrame]:
+    if clip_bounds is not None:
+        clip_bounds = _snap_clip_bounds(clip_bounds, crs)
+    key = cache.key(path, left_bottom, right_top, crs, clip_bounds)
+    cached = cache.load(key)
+    if cached is not None:
+        profiling.count('cache_hits', 1)
+        return cached
+
+    if batch_size:
+        df_projected = load_projected_streamed(path, left_bottom, right_top, crs, batch_size, clip_bounds)
+    else:
+        df_culled = load_geojson(path, left_bottom, right_top)
+        validate_data(df_culled)
+        df_projected = project_geometry(df_culled, crs) if clip_bounds is None else clip_and_project(df_culled, clip_bounds, crs)
+    df_polygons = contours_to_polygons(df_projected)
+    cache.store(key, df_projected, df_polygons)
+    return df_projected, df_polygons
+
+'''
+    Расширяет прямоугольник обрезки clip_bounds.projected до решётки с шагом CLIP_LATTICE и строит для него области обрезки (см. area_clip_bounds).
+'''
+def _snap_clip_bounds(clip_bounds: ClipBounds, crs: str) -> ClipBounds:
+    (min_x, min_y), (max_x, max_y) = clip_bounds.projected
+    left_bottom = (float(np.floor(min_x / CLIP_LATTICE)*CLIP_LATTICE), float(np.floor(min_y / CLIP_LATTICE)*CLIP_LATTICE))
+    right_top = (float(np.ceil(max_x / CLIP_LATTICE)*CLIP_LATTICE), float(np.ceil(max_y / CLIP_LATTICE)*CLIP_LATTICE))
+    return area_clip_bounds(left_bottom, right_top, crs)
@@ -1,10 +1,12 @@
 import geopandas as gpd
 from shapely.geometry import Polygon, MultiPolygon, LineString
 from shapely.ops import unary_union
-import matplotlib.pyplot as plt
 import modules.processing as prc
+from modules import profiling
+from modules.nesting import ContourTree
 
 # Функция для преобразования контуров в полигоны
+@profiling.stage('contours_to_polygons', lambda df: {'polygons': len(df)})
 def contours_to_polygons(df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     # Сортировка высот по убыванию
     elevations = sorted(df['elevation'].unique(), reverse=True)
@@ -19,6 +21,8 @@ def contours_to_polygons(df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         exterior_coords = group.geometry[group.geometry.apply(lambda geom: isinstance(geom, LineString) and geom.is_ring)].apply(lambda line: line.coords)
         interior_coords = group.geometry[group.geometry.apply(lambda geom: isinstance(geom, Polygon))].apply(lambda poly: [interior.coords for interior in poly.interiors]).explode(index_parts=False)
 
+        profiling.count('rings', len(exterior_coords))
+
         # Создание внешних полигонов
         exterior_polygons = list(map(Polygon, exterior_coords))
         unioned_polygon = unary_union(exterior_polygons)
@@ -32,32 +36,16 @@ def contours_to_polygons(df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
     # Создание GeoDataFrame из полигонов
     polygons_df = gpd.GeoDataFrame(polygons, crs=df.crs)
 
-    # Обработка внутренних полигонов
+    # Построение иерархии вложенности полигонов
+    tree = ContourTree.from_frame(polygons_df)
+
+    # Вычитание дыр: из каждого полигона вычитаются только ближайшие вложенные полигоны с меньшей высотой
     final_polygons = []
-    for i, poly in polygons_df.iterrows():
-        current_polygon = poly['geometry']
-
-        # Поиск и вычитание внутренних полигонов
-        for j, inner_poly in polygons_df[polygons_df['elevation'] < poly['elevation']].iterrows():
-            inner_geom = inner_poly['geometry']
-            
-            # Проверка типов текущего и внутреннего полигонов
-            if isinstance(inner_geom, Polygon) and isinstance(current_polygon, Polygon) and current_polygon.contains(inner_geom):
-                current_polygon = current_polygon.difference(inner_geom)
-            elif isinstance(inner_geom, MultiPolygon):
-                # Проверка типов текущего полигона и вычитаемого полигона
-                if isinstance(current_polygon, Polygon):
-                    # Если текущий полигон - Polygon, итерация по всем внутренним полигонам в MultiPolygon
-                    for sub_poly in inner_geom.geoms:
-                        # Проверка содержания внутреннего полигона в текущем полигоне
-                        if current_polygon.contains(sub_poly):
-                            current_polygon = current_polygon.difference(sub_poly)
-                elif isinstance(current_polygon, MultiPolygon):
-                    # Если текущий полигон - MultiPolygon, итерация по всем его составляющим
-                    new_geoms = [geom.difference(inner_geom) if geom.intersects(inner_geom) else geom for geom in current_polygon.geoms]
-                    current_polygon = MultiPolygon(new_geoms)
-
-        final_polygons.append({'elevation': poly['elevation'], 'geometry': current_polygon})
+    for i, poly in enumerate(tree.geometries):
+        holes = tree.holes(i)
+        if holes:
+            poly = poly.difference(unary_union(tree.geometries[holes]))
+        final_polygons.append({'elevation': tree.elevations[i], 'geometry': poly})
 
     # Объединение полигонов на одной высоте
     final_df = gpd.GeoDataFrame(final_polygons, crs=df.crs)
@@ -92,6 +80,8 @@ if __name__ == '__main__':
     df_polygons_wgs84.to_file('contours.geojson', driver='GeoJSON')
 
     # Визуализация данных
+    import matplotlib.pyplot as plt
+
     fig, axes = plt.subplots(1, 3, figsize=(15, 5))
 
     # Исходные данные
@@ -0,0 +1,278 @@
+import geopandas
+import hashlib
+import json
+import numpy as np
+import os
+import pyogrio
+import shapely
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, NamedTuple
+from modules import profiling
+from modules.contours import contours_to_polygons
+from modules.processing import GridGeoreference, NODATA_VALUE, get_transformer, load_geojson, validate_data, project_geometry
+from modules.rasterization import rasterize_height_map
+from modules.streaming import iter_geojson_batches
+from modules.tiling import GridTile, select_tile_features, tile_georeference
+from modules.writers import write_ascii_grid
+
+'''
+    Манифест карты высот: хэши и ограничивающие прямоугольники (WGS84) фитч исходного файла, по которым она построена,
+    параметры построения и длительность полного построения.
+    Поля:
+        source : str - путь до файла с контурами.
+        left_bottom : tuple[float, float] - левый нижний угол загруженного региона в WGS84.
+        right_top : tuple[float, float] - правый верхний угол загруженного региона в WGS84.
+        georeference : GridGeoreference - геопривязка карты высот.
+        output : str - путь до файла карты высот.
+        format : str - формат файла карты высот ('asc', 'flt' или 'npy').
+        full_run_s : float - длительность полного построения карты высот в секундах.
+        digests : np.ndarray - хэши фитч (по геометрии и высоте).
+        bounds : np.ndarray - ограничивающие прямоугольники фитч формы (n, 4).
+'''
+class FeatureManifest(NamedTuple):
+    source: str
+    left_bottom: tuple[float, float]
+    right_top: tuple[float, float]
+    georeference: GridGeoreference
+    output: str
+    format: str
+    full_run_s: float
+    digests: np.ndarray
+    bounds: np.ndarray
+
+'''
+    Возвращает путь манифеста для файла карты высот output.
+'''
+def manifest_path(output: str) -> str:
+    return f'{output}.manifest.npz'
+
+'''
+    Вычисляет хэши и ограничивающие прямоугольники фитч файла path в регионе left_bottom/right_top, читая файл потоково пакетами по batch_size фитч.
+    Хэш фитчи зависит только от её геометрии (WKB) и высоты, поэтому изменение прочих свойств не считается изменением.
+'''
+@profiling.stage('feature_digests', lambda result: {'features': len(result[0])})
+def feature_digests(path: str, left_bottom: tuple[float, float], right_top: tuple[float, float], batch_size: int = 10000) -> tuple[np.ndarray, np.ndarray]:
+    digests = []
+    bounds = []
+    for batch in iter_geojson_batches(path, left_bottom, right_top, batch_size):
+        geometries = batch.geometry.to_numpy()
+        elevations = batch['elevation'].to_numpy(dtype=np.float64) if 'elevation' in batch else np.full(len(batch), np.nan)
+        for wkb, elevation in zip(shapely.to_wkb(geometries), elevations):
+            digests.append(hashlib.blake2b(wkb + elevation.tobytes(), digest_size=16).digest())
+        bounds.append(shapely.bounds(geometries))
+    return np.array(digests, dtype='S16'), np.concatenate(bounds) if bounds else np.empty((0, 4))
+
+'''
+    Строит манифест карты высот output (см. FeatureManifest) и записывает его в manifest_path(output).
+'''
+def write_manifest(source: str, left_bottom: tuple[float, float], right_top: tuple[float, float], georeference: GridGeoreference,
+                   output: str, format: str, full_run_s: float, batch_size: int = 10000) -> FeatureManifest:
+    digests, bounds = feature_digests(source, left_bottom, right_top, batch_size)
+    manifest = FeatureManifest(source, left_bottom, right_top, georeference, output, format, full_run_s, digests, bounds)
+    save_manifest(manifest_path(output), manifest)
+    return manifest
+
+'''
+    Сохраняет манифест в файл path (.npz). Файл заменяется целиком, чтобы прерванная запись не испортила предыдущий манифест.
+'''
+def save_manifest(path: str, manifest: FeatureManifest):
+    meta = manifest._asdict()
+    digests, bounds = meta.pop('digests'), meta.pop('bounds')
+    meta['georeference'] = manifest.georeference._asdict()
+    descriptor, staging = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.manifest-', suffix='.npz')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            np.savez(file, meta=np.array(json.dumps(meta)), digests=digests, bounds=bounds)
+        os.replace(staging, path)
+    except BaseException:
+        os.remove(staging)
+        raise
+
+'''
+    Загружает манифест из файла path.
+'''
+def load_manifest(path: str) -> FeatureManifest:
+    with np.load(path) as data:
+        meta = json.loads(str(data['meta']))
+        digests, bounds = data['digests'], data['bounds']
+    georeference = meta['georeference']
+    return FeatureManifest(
+        meta['source'],
+        tuple(meta['left_bottom']),
+        tuple(meta['right_top']),
+        GridGeoreference(tuple(georeference['left_bottom']), georeference['step_size'], georeference['column_count'], georeference['row_count'], georeference['crs']),
+        meta['output'],
+        meta['format'],
+        meta['full_run_s'],
+        digests,
+        bounds,
+    )
+
+'''
+    Обновляет карту высот после изменения исходного файла, не перестраивая её целиком.
+    Фитчи нового файла source (по умолчанию - файла из манифеста) сравниваются по хэшам с манифестом. Изменение контура меняет полигоны
+    высот (его собственный и полигон охватывающего контура, в котором он был дырой) только внутри самого контура, поэтому пересчитываются
+    лишь ячейки, центры которых лежат в ограничивающих прямоугольниках удалённых и добавленных фитч, расширенных на halo.
+    Окна (пересекающиеся окна объединяются) строятся так же, как тайлы generate_height_map_tiled: из фитч нового файла,
+    ограничивающий прямоугольник которых пересекает окно с запасом halo, поэтому для непересекающихся контуров результат совпадает
+    с полным построением (пересекающиеся контуры - см. select_tile_features).
+    Пересчитанные окна записываются в файл карты высот на месте (.npy и .flt через memmap, ASCII grid перезаписывается), а манифест обновляется.
+    Аргументы:
+        path : str - путь до манифеста.
+        source : str | None - путь до нового файла с контурами.
+        halo : float - запас вокруг изменённых фитч и окон (в единицах crs). Должен превышать 1 метр, на который расширяются полигоны при сэмплировании.
+        batch_size : int - размер пакета при потоковом чтении нового файла.
+    Возвращает:
+        dict - отчёт: число добавленных и удалённых фитч, окон, пересчитанных и всех ячеек, длительность обновления,
+               длительность полного построения из манифеста и сэкономленное время.
+'''
+@profiling.stage('update_height_map')
+def update_height_map(path: str, source: str | None = None, halo: float = 10, batch_size: int = 10000) -> dict:
+    if halo <= 1:
+        raise ValueError('halo should be greater than 1')
+    started = time.perf_counter()
+    manifest = load_manifest(path)
+    source = source or manifest.source
+    georeference = manifest.georeference
+
+    digests, bounds = feature_digests(source, manifest.left_bottom, manifest.right_top, batch_size)
+    added = _multiset_difference(digests, manifest.digests)
+    removed = _multiset_difference(manifest.digests, digests)
+    changed = np.concatenate([bounds[added], manifest.bounds[removed]])
+
+    to_crs = get_transformer('EPSG:4326', georeference.crs)
+    windows = _merge_windows([window for window in (_cell_window(georeference, to_crs.transform_bounds(*box, densify_pts=21), halo) for box in changed) if window])
+
+    if windows:
+        #Фитчи нового файла, нужные для всех окон, загружаются и преобразуются в полигоны один раз
+        fids, feature_bounds = pyogrio.read_bounds(source, bbox=(*manifest.left_bottom, *manifest.right_top))
+        to_wgs84 = get_transformer(georeference.crs, 'EPSG:4326')
+        window_georefs = [tile_georeference(georeference, window) for window in windows]
+        window_fids = sorted(set().union(*(select_tile_features(fids, feature_bounds, to_wgs84, window_georef, halo) for window_georef in window_georefs)))
+        df = load_geojson(source, fids=window_fids)
+        validate_data(df)
+        polygons = contours_to_polygons(project_geometry(df, georeference.crs))
+
+        with _open_height_map(manifest.output, manifest.format, georeference) as heights:
+            for window, window_georef in zip(windows, window_georefs):
+                patch, _ = rasterize_height_map(_clip_polygons(polygons, window_georef, halo), window_georef.left_bottom, window_georef.step_size,
+                                                window_georef.column_count, window_georef.row_count, window_georef.crs)
+                heights[window.row_start:window.row_end, window.column_start:window.column_end] = patch
+
+    save_manifest(path, manifest._replace(source=source, digests=digests, bounds=bounds))
+    touched = sum((window.row_end - window.row_start)*(window.column_end - window.column_start) for window in windows)
+    profiling.count('touched_cells', touched)
+    elapsed = time.perf_counter() - started
+    return {
+        'added_features': len(added),
+        'removed_features': len(removed),
+        'windows': len(windows),
+        'touched_cells': touched,
+        'total_cells': georeference.row_count*georeference.column_count,
+        'elapsed_s': elapsed,
+        'full_run_s': manifest.full_run_s,
+        'saved_s': manifest.full_run_s - elapsed,
+    }
+
+'''
+    Обрезает полигоны по области центров ячеек сетки georeference, расширенной на halo. Расширение полигонов на 1 метр при сэмплировании
+    зависит только от их частей в пределах 1 метра от центра ячейки, поэтому при halo больше 1 результат сэмплирования не меняется,
+    а большие полигоны, охватывающие окно, не приходится расширять целиком.
+'''
+def _clip_polygons(polygons: geopandas.GeoDataFrame, georeference: GridGeoreference, halo: float) -> geopandas.GeoDataFrame:
+    half = georeference.step_size//2
+    clipped = shapely.clip_by_rect(
+        polygons.geometry.to_numpy(),
+        georeference.left_bottom[0] + half - halo,
+        georeference.left_bottom[1] + half - halo,
+        georeference.left_bottom[0] + half + (georeference.column_count - 1)*georeference.step_size + halo,
+        georeference.left_bottom[1] + half + (georeference.row_count - 1)*georeference.step_size + halo,
+    )
+    keep = ~shapely.is_empty(clipped)
+    return geopandas.GeoDataFrame({'elevation': polygons['elevation'].to_numpy()[keep]}, geometry=clipped[keep], crs=polygons.crs)
+
+'''
+    Индексы элементов digests, которых нет в other (с учётом кратности).
+'''
+def _multiset_difference(digests: np.ndarray, other: np.ndarray) -> np.ndarray:
+    remaining = Counter(other.tolist())
+    indices = []
+    for i, digest in enumerate(digests.tolist()):
+        if remaining[digest] > 0:
+            remaining[digest] -= 1
+        else:
+            indices.append(i)
+    return np.array(indices, dtype=np.int64)
+
+'''
+    Окно ячеек сетки georeference (строка 0 - верхняя), центры которых лежат в прямоугольнике box (в crs), расширенном на halo,
+    или None, если таких ячеек нет.
+'''
+def _cell_window(georeference: GridGeoreference, box: tuple[float, float, float, float], halo: float) -> GridTile | None:
+    step = georeference.step_size
+    origin = (georeference.left_bottom[0] + step//2, georeference.left_bottom[1] + step//2)
+    column_start = max(int(np.ceil((box[0] - halo - origin[0]) / step)), 0)
+    column_end = min(int(np.floor((box[2] + halo - origin[0]) / step)) + 1, georeference.column_count)
+    #Строки, считая снизу
+    row_start = max(int(np.ceil((box[1] - halo - origin[1]) / step)), 0)
+    row_end = min(int(np.floor((box[3] + halo - origin[1]) / step)) + 1, georeference.row_count)
+    if column_start >= column_end or row_start >= row_end:
+        return None
+    return GridTile(georeference.row_count - row_end, georeference.row_count - row_start, column_start, column_end)
+
+'''
+    Объединяет пересекающиеся окна в их общие ограничивающие окна, пока пересечений не останется.
+'''
+def _merge_windows(windows: list[GridTile]) -> list[GridTile]:
+    merged = True
+    while merged:
+        merged = False
+        result : list[GridTile] = []
+        for window in windows:
+            for i, other in enumerate(result):
+                if window.row_start < other.row_end and other.row_start < window.row_end and window.column_start < other.column_end and other.column_start < window.column_end:
+                    result[i] = GridTile(min(window.row_start, other.row_start), max(window.row_end, other.row_end),
+                                         min(window.column_start, other.column_start), max(window.column_end, other.column_end))
+                    merged = True
+                    break
+            else:
+                result.append(window)
+        windows = result
+    return windows
+
+'''
+    Открывает файл карты высот path для изменения на месте. Возвращаемый массив принимает окна высот с nan,
+    которые при записи заменяются на значение "нет данных" формата файла.
+'''
+@contextmanager
+def _open_height_map(path: str, format: str, georeference: GridGeoreference) -> Iterator['_HeightMapView']:
+    shape = (georeference.row_count, georeference.column_count)
+    if format == 'npy':
+        heights = np.load(path, mmap_mode='r+')
+    elif format == 'flt':
+        heights = np.memmap(path, dtype='<f4', mode='r+', shape=shape)
+    elif format == 'asc':
+        #Текстовый файл нельзя изменить на месте, поэтому он читается целиком и перезаписывается после изменения
+        heights = np.loadtxt(path, skiprows=6, ndmin=2)
+    else:
+        raise ValueError(f'Unknown output format `{format}`.')
+    if heights.shape != shape:
+        raise ValueError(f'Height map shape {heights.shape} does not match the manifest {shape}.')
+
+    yield _HeightMapView(heights, np.nan if format == 'npy' else NODATA_VALUE)
+
+    if format == 'asc':
+        write_ascii_grid(path, np.where(heights == NODATA_VALUE, np.nan, heights), georeference)
+    else:
+        heights.flush()
+
+class _HeightMapView:
+    def __init__(self, heights: np.ndarray, nodata: float):
+        self.heights = heights
+        self.nodata = nodata
+
+    def __setitem__(self, index: tuple[slice, slice], patch: np.ndarray):
+        self.heights[index] = np.where(np.isnan(patch), self.nodata, patch)
@@ -0,0 +1,164 @@
+import geopandas
+import json
+import numpy as np
+import shapely
+from typing import NamedTuple
+from modules import profiling
+from modules.cache import ContourCache, load_polygons_cached
+from modules.contours import contours_to_polygons
+from modules.processing import GridGeoreference, MSK_48_CRS, load_geojson, validate_data, project_geometry, wgs84_point_to_crs
+from modules.rasterization import rasterize_height_map
+from modules.streaming import load_geojson_streamed
+from modules.writers import OUTPUT_EXTENSIONS, write_height_map
+
+'''
+    Задание на построение одной карты высот.
+    Поля:
+        left_bottom : tuple[float, float] - левый нижний угол области в WGS84. Проекция этой точки в crs задаёт левый нижний угол сетки.
+        right_top : tuple[float, float] - правый верхний угол области в WGS84.
+        step_size : int - шаг сетки.
+        column_count : int - число столбцов сетки.
+        row_count : int - число строк сетки.
+        crs : str - система координат сетки.
+        format : str - формат файла карты высот ('asc', 'flt' или 'npy').
+        output : str - путь до файла карты высот.
+'''
+class HeightMapJob(NamedTuple):
+    left_bottom: tuple[float, float]
+    right_top: tuple[float, float]
+    step_size: int
+    column_count: int
+    row_count: int
+    crs: str
+    format: str
+    output: str
+
+'''
+    Читает задания из JSONL файла: по одному JSON объекту на строку с полями HeightMapJob.
+    Поля crs (по умолчанию MSK_48_CRS), format (по умолчанию 'asc') и output (по умолчанию heightmap_<номер>_<параметры сетки>) необязательны.
+'''
+def read_jobs(path: str) -> list[HeightMapJob]:
+    jobs = []
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            fields = json.loads(line)
+            for name in ('left_bottom', 'right_top', 'step_size', 'column_count', 'row_count'):
+                if name not in fields:
+                    raise KeyError(f'Missing field `{name}` in the job on line {line_number}.')
+            format = fields.get('format', 'asc')
+            if format not in OUTPUT_EXTENSIONS:
+                raise ValueError(f'Unknown output format `{format}` in the job on line {line_number}.')
+            output = fields.get('output', f'heightmap_{len(jobs)}_{fields["step_size"]}m_{fields["column_count"]}c_{fields["row_count"]}r{OUTPUT_EXTENSIONS[format]}')
+            jobs.append(HeightMapJob(
+                tuple(fields['left_bottom']),
+                tuple(fields['right_top']),
+                int(fields['step_size']),
+                int(fields['column_count']),
+                int(fields['row_count']),
+                fields.get('crs', MSK_48_CRS),
+                format,
+                output,
+            ))
+    return jobs
+
+'''
+    Контуры одной области, загруженные один раз и используемые для многих карт высот.
+    Контуры загружаются и валидируются при первом обращении, а полигоны высот и их пространственный индекс (STRtree)
+    строятся один раз для каждой используемой системы координат. Карта высот строится растеризацией только тех полигонов,
+    которые индекс находит в окне её сетки.
+    Аргументы конструктора:
+        path : str - путь до файла с контурами.
+        left_bottom : tuple[float, float] - левый нижний угол загружаемого региона в WGS84.
+        right_top : tuple[float, float] - правый верхний угол загружаемого региона в WGS84.
+        cache : ContourCache | None - кэш спроецированных контуров и полигонов.
+        batch_size : int | None - размер пакета при потоковом чтении, None - чтение файла целиком.
+'''
+class SharedTerrain:
+    def __init__(self, path: str, left_bottom: tuple[float, float], right_top: tuple[float, float], cache: ContourCache | None = None, batch_size: int | None = None):
+        self.path = path
+        self.left_bottom = left_bottom
+        self.right_top = right_top
+        self.cache = cache
+        self.batch_size = batch_size
+        self._contours : geopandas.GeoDataFrame | None = None
+        self._layers : dict[str, tuple[geopandas.GeoDataFrame, shapely.STRtree]] = {}
+
+    '''
+        Создаёт общие данные для заданий jobs: загружаемый регион - объединение областей всех заданий.
+    '''
+    @classmethod
+    def for_jobs(cls, path: str, jobs: list[HeightMapJob], cache: ContourCache | None = None, batch_size: int | None = None) -> 'SharedTerrain':
+        left_bottom = (min(job.left_bottom[0] for job in jobs), min(job.left_bottom[1] for job in jobs))
+        right_top = (max(job.right_top[0] for job in jobs), max(job.right_top[1] for job in jobs))
+        return cls(path, left_bottom, right_top, cache, batch_size)
+
+    '''
+        Возвращает загруженные и провалидированные контуры региона в WGS84.
+    '''
+    def contours(self) -> geopandas.GeoDataFrame:
+        if self._contours is None:
+            if self.batch_size:
+                self._contours = load_geojson_streamed(self.path, self.left_bottom, self.right_top, self.batch_size)
+            else:
+                self._contours = load_geojson(self.path, self.left_bottom, self.right_top)
+            validate_data(self._contours)
+        return self._contours
+
+    '''
+        Возвращает полигоны высот в системе координат crs и пространственный индекс по ним.
+    '''
+    def layer(self, crs: str) -> tuple[geopandas.GeoDataFrame, shapely.STRtree]:
+        if crs not in self._layers:
+            if self.cache is not None:
+                _, polygons = load_polygons_cached(self.cache, self.path, self.left_bottom, self.right_top, crs, self.batch_size)
+            else:
+                polygons = contours_to_polygons(project_geometry(self.contours(), crs))
+            self._layers[crs] = (polygons, shapely.STRtree(polygons.geometry.to_numpy()))
+        return self._layers[crs]
+
+    '''
+        Возвращает полигоны высот в системе координат crs, которые могут повлиять на ячейки сетки с указанными параметрами.
+        Полигоны расширяются на 1 метр при сэмплировании, поэтому окно запроса берётся с запасом.
+    '''
+    def polygons_for_grid(self, leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int, crs: str) -> geopandas.GeoDataFrame:
+        polygons, index = self.layer(crs)
+        window = shapely.box(leftBottom[0] - 2, leftBottom[1] - 2, leftBottom[0] + stepSize*columnCount + 2, leftBottom[1] + stepSize*rowCount + 2)
+        return polygons.iloc[np.sort(index.query(window))]
+
+    '''
+        Строит карту высот сетки с указанными параметрами (как rasterize_height_map) по общим данным.
+    '''
+    def sample(self, leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int, crs: str) -> tuple[np.ndarray, GridGeoreference]:
+        return rasterize_height_map(self.polygons_for_grid(leftBottom, stepSize, columnCount, rowCount, crs), leftBottom, stepSize, columnCount, rowCount, crs)
+
+'''
+    Выполняет задание job по общим данным terrain и записывает карту высот в job.output.
+    При plot=True рядом сохраняется изображение карты высот (<output>.png); matplotlib загружается только в этом случае.
+'''
+@profiling.stage('run_job')
+def run_job(terrain: SharedTerrain, job: HeightMapJob, plot: bool = False) -> GridGeoreference:
+    projected = wgs84_point_to_crs(job.left_bottom, job.crs)
+    heights, georeference = terrain.sample((int(projected[0]), int(projected[1])), job.step_size, job.column_count, job.row_count, job.crs)
+    write_height_map(job.output, heights, georeference, job.format)
+    if plot:
+        plot_height_map(f'{job.output}.png', heights, georeference)
+    return georeference
+
+'''
+    Сохраняет изображение карты высот в файл path без использования дисплея.
+'''
+def plot_height_map(path: str, heights: np.ndarray, georeference: GridGeoreference):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    left, bottom = georeference.left_bottom
+    extent = (left, left + georeference.step_size*georeference.column_count, bottom, bottom + georeference.step_size*georeference.row_count)
+    fig, axis = plt.subplots(figsize=(8, 8))
+    image = axis.imshow(heights, extent=extent)
+    fig.colorbar(image, ax=axis)
+    axis.set_title('Карта высот')
+    fig.savefig(path)
+    plt.close(fig)
@@ -0,0 +1,129 @@
+import geopandas
+import numpy as np
+import shapely
+
+'''
+    Иерархия вложенности полигонов высот.
+    Для каждого полигона определяется непосредственный родитель - наименьший по площади полигон, полностью содержащий данный.
+    Кандидаты в родители находятся одним пакетным запросом к STRtree, поэтому построение дерева не требует попарного сравнения всех полигонов.
+    Аргументы конструктора:
+        geometries - последовательность полигонов (shapely.Polygon).
+        elevations - высоты полигонов в том же порядке.
+'''
+class ContourTree:
+    def __init__(self, geometries, elevations):
+        self.geometries = np.asarray(geometries, dtype=object)
+        self.elevations = np.asarray(elevations, dtype=np.float64)
+        self.index = shapely.STRtree(self.geometries)
+
+        count = len(self.geometries)
+        areas = shapely.area(self.geometries)
+        #Пары (вложенный, содержащий), в которых первый полигон лежит внутри второго
+        inner, outer = self.index.query(self.geometries, predicate='within')
+        #Отбрасываем сам полигон, а для совпадающих полигонов оставляем одно направление, чтобы не получить цикл
+        keep = (inner != outer) & ((areas[outer] > areas[inner]) | ((areas[outer] == areas[inner]) & (outer < inner)))
+        inner, outer = inner[keep], outer[keep]
+        #Непосредственный родитель - содержащий полигон с наименьшей площадью
+        order = np.lexsort((outer, areas[outer], inner))
+        inner, outer = inner[order], outer[order]
+        _, first = np.unique(inner, return_index=True)
+
+        self.parents = np.full(count, -1, dtype=np.int64)
+        self.parents[inner[first]] = outer[first]
+        self._children : list[list[int]] = [[] for _ in range(count)]
+        for child, parent in enumerate(self.parents):
+            if parent >= 0:
+                self._children[parent].append(child)
+
+        #Глубина узла: 0 у корней
+        self.depths = np.zeros(count, dtype=np.int64)
+        for node in self._topological_order():
+            if self.parents[node] >= 0:
+                self.depths[node] = self.depths[self.parents[node]] + 1
+
+        self._holes : list[list[int]] = [[] for _ in range(count)]
+        for node in range(count):
+            for ancestor in self._hole_owners(node):
+                self._holes[ancestor].append(node)
+
+    '''
+        Строит дерево по датафрейму с колонками elevation и geometry (например, по промежуточным полигонам contours_to_polygons).
+    '''
+    @classmethod
+    def from_frame(cls, df: geopandas.GeoDataFrame) -> 'ContourTree':
+        return cls(df.geometry.to_numpy(), df['elevation'].to_numpy())
+
+    def __len__(self) -> int:
+        return len(self.geometries)
+
+    '''
+        Возвращает индекс непосредственного родителя полигона или None, если полигон является корнем.
+    '''
+    def parent(self, node: int) -> int | None:
+        parent = int(self.parents[node])
+        return parent if parent >= 0 else None
+
+    '''
+        Возвращает индексы полигонов, непосредственным родителем которых является данный полигон.
+    '''
+    def children(self, node: int) -> list[int]:
+        return list(self._children[node])
+
+    '''
+        Возвращает индексы всех содержащих полигон полигонов, начиная с непосредственного родителя.
+    '''
+    def ancestors(self, node: int) -> list[int]:
+        out = []
+        parent = self.parents[node]
+        while parent >= 0:
+            out.append(int(parent))
+            parent = self.parents[parent]
+        return out
+
+    '''
+        Возвращает индексы полигонов, не содержащихся ни в одном другом полигоне.
+    '''
+    def roots(self) -> list[int]:
+        return [int(node) for node in np.flatnonzero(self.parents < 0)]
+
+    '''
+        Возвращает индексы полигонов, которые нужно вычесть из данного полигона как дыры:
+        ближайшие вложенные полигоны с меньшей высотой (полигоны, вложенные в них, уже лежат внутри дыры).
+    '''
+    def holes(self, node: int) -> list[int]:
+        return list(self._holes[node])
+
+    '''
+        Возвращает индекс самого глубоко вложенного полигона, содержащего точку (x, y), или None, если таких нет.
+    '''
+    def locate(self, x: float, y: float) -> int | None:
+        candidates = self.index.query(shapely.Point(x, y), predicate='within')
+        if len(candidates) == 0:
+            return None
+        return int(candidates[np.argmax(self.depths[candidates])])
+
+    '''
+        Перечисляет узлы так, что родитель всегда идёт раньше своих потомков.
+    '''
+    def _topological_order(self) -> list[int]:
+        order = self.roots()
+        for node in order:
+            order.extend(self._children[node])
+        return order
+
+    '''
+        Поднимается от узла к корню и перечисляет предков, для которых узел является дырой:
+        предок выше узла, а все полигоны между ними не ниже этого предка.
+    '''
+    def _hole_owners(self, node: int) -> list[int]:
+        owners = []
+        elevation = self.elevations[node]
+        lowest_between = np.inf
+        parent = self.parents[node]
+        #Если между узлом и предком уже встретился полигон не выше узла, ни один из более дальних предков не подходит
+        while parent >= 0 and lowest_between > elevation:
+            if elevation < self.elevations[parent] <= lowest_between:
+                owners.append(int(parent))
+            lowest_between = min(lowest_between, self.elevations[parent])
+            parent = self.parents[parent]
+        return owners
@@ -1,9 +1,40 @@
+import functools
 import geopandas
+import numpy as np
+import pandas
 import pyproj
 import shapely
-from typing import cast, Final
+from typing import cast, Final, NamedTuple, Sequence
+from modules import profiling
 
 MSK_48_CRS : Final[str] = '+proj=tmerc +lat_0=0 +lon_0=38.48333333333 +k=1 +x_0=1250000 +y_0=-5412900.566 +ellps=krass +towgs84=23.57,-140.95,-79.8,0,0.35,0.79,-0.22 +units=m +no_defs'
+NODATA_VALUE : Final[float] = -99999
+
+'''
+    Геопривязка регулярной сетки высот.
+    Поля:
+        left_bottom : tuple[int, int] - левый нижний угол сетки (угол ячейки, а не её центр) в координатах crs.
+        step_size : int - размер ячейки сетки.
+        column_count : int - число столбцов сетки.
+        row_count : int - число строк сетки.
+        crs : str - система координат сетки.
+'''
+class GridGeoreference(NamedTuple):
+    left_bottom: tuple[int, int]
+    step_size: int
+    column_count: int
+    row_count: int
+    crs: str
+
+'''
+    Области обрезки контуров для сетки (см. grid_clip_bounds).
+    Поля:
+        wgs84 : tuple[tuple[float, float], tuple[float, float]] - прямоугольник в WGS84 для обрезки до проецирования.
+        projected : tuple[tuple[float, float], tuple[float, float]] - прямоугольник в системе координат сетки для обрезки после проецирования.
+'''
+class ClipBounds(NamedTuple):
+    wgs84: tuple[tuple[float, float], tuple[float, float]]
+    projected: tuple[tuple[float, float], tuple[float, float]]
 
 '''
     Загружает указанный путём geojson файл в GeoDataFrame
@@ -15,37 +46,197 @@ MSK_48_CRS : Final[str] = '+proj=tmerc +lat_0=0 +lon_0=38.48333333333 +k=1 +x_0=
         right_top : tuple[float, float] | None - правый верхний угол (в таком порядке компонентов) загружаемого региона.
                                                     Все фитчи полностью вне региона будут проигноированы при загрузке. 
                                                     Имеет эффект, только если left_bottom тоже не None.
+        fids : Sequence[int] | None - идентификаторы загружаемых фитч (например, полученные от pyogrio.read_bounds).
+                                        Если задан, регион не учитывается.
     Возвращает:
         geopandas.GeoDataFrame - датафрейм содержащий фитчи, их геометрии и параметры.
 '''
-def load_geojson(path: str, left_bottom: tuple[float, float] | None = None, right_top: tuple[float, float] | None = None) -> geopandas.GeoDataFrame:
-    if (left_bottom and right_top):
+@profiling.stage('load_geojson', lambda df: {'features': len(df)})
+def load_geojson(path: str, left_bottom: tuple[float, float] | None = None, right_top: tuple[float, float] | None = None, fids: Sequence[int] | None = None) -> geopandas.GeoDataFrame:
+    if fids is not None:
+        return geopandas.read_file(path, fids=fids)
+    elif (left_bottom and right_top):
         return geopandas.read_file(path, bbox=(*left_bottom, *right_top))
     else:
         return geopandas.read_file(path)
 
 '''
     Производит валидацию датафрейма на совместимость с модулем (для дальнейшей работы).
-    Проверяет датафрейм на наличие столбцов geometry и elevation, на отсутствие nan-значений, на отсутствие некольцевых геометрий.
+    Проверяет датафрейм на наличие столбцов geometry и elevation, на отсутствие nan-значений в них и на отсутствие некольцевых геометрий.
+    Проверки выполняются одним векторизованным проходом по столбцам, а в сообщении об ошибке перечисляются индексы нарушающих фитч.
     Устаналивает активную геометрию на столбец geometry.
 '''
+@profiling.stage('validate_data')
 def validate_data(df: geopandas.GeoDataFrame):
+    profiling.count('features', len(df))
     expected_columns = ['elevation', 'geometry']
     for column in expected_columns:
         if not column in df.columns:
             raise KeyError(f'Missing column `{column}` the in dataframe.')
 
-    if df.isnull().any().any():
-        raise ValueError('Detected missing values (NaNs) in the dataframe.')
-    
-    if len(df[df['geometry'].is_ring == False]) > 0:
-        raise ValueError('Detected non-ring geometries in the dataframe.')
+    geometries = np.asarray(df['geometry'].array, dtype=object)
+    missing = df['elevation'].isna().to_numpy() | shapely.is_missing(geometries)
+    if missing.any():
+        raise ValueError(f'Detected missing values (NaNs) in the dataframe, features: {_format_indices(df.index[missing])}.')
+
+    non_rings = ~shapely.is_ring(geometries)
+    if non_rings.any():
+        raise ValueError(f'Detected non-ring geometries in the dataframe, features: {_format_indices(df.index[non_rings])}.')
     
     df.set_geometry('geometry', inplace=True)
-    
+
+'''
+    Перечисляет через запятую первые limit индексов фитч и число остальных.
+'''
+def _format_indices(indices: Sequence, limit: int = 10) -> str:
+    shown = ', '.join(str(index) for index in indices[:limit])
+    return shown if len(indices) <= limit else f'{shown} and {len(indices) - limit} more'
+
+'''
+    Обрезает кольцевые контуры df по прямоугольнику left_bottom/right_top (в системе координат df), чтобы дальнейшие этапы
+    (проецирование, построение полигонов) обрабатывали только вершины рядом с областью интереса. Полигоны высот внутри прямоугольника не меняются:
+        - контуры внутри прямоугольника сохраняются как есть, а контуры вне его, не охватывающие его, отбрасываются;
+        - контур, пересекающий границу прямоугольника, заменяется внешними кольцами частей пересечения своей области с прямоугольником
+          (замкнутыми линиями, как и исходные контуры), вершины которых на границе лежат точно на сторонах прямоугольника;
+        - контуры, охватывающие прямоугольник целиком, заменяются вложенными друг в друга прямоугольниками чуть больше него (в порядке площади
+          исходных контуров), чтобы сохранилась их взаимная вложенность, от которой зависит вычитание дыр в contours_to_polygons.
+    Части вложенных друг в друга контуров, обрезанных по одной стороне прямоугольника, лежат друг в друге только в системе координат обрезки:
+    после проецирования прямая сторона искривляется. Поэтому контуры в WGS84 обрезаются для сетки функцией clip_and_project.
+    Прямоугольник должен быть больше области сэмплирования с запасом: у его границы полигоны отличаются от полигонов без обрезки.
+    Исключение - совпадающие контуры с разными высотами: их вложенность и без обрезки определяется погрешностью вычисления площади.
+    Ожидает провалидированный датафрейм (validate_data).
+    Для датафрейма, читаемого пакетами, обрезка выполняется по частям: split_clipped_contours для каждого пакета
+    и frame_enclosing_contours для охватывающих контуров всех пакетов вместе (их рамки зависят от площадей всех таких контуров).
+'''
+@profiling.stage('clip_contours', lambda df: {'features': len(df)})
+def clip_contours(df: geopandas.GeoDataFrame, left_bottom: tuple[float, float], right_top: tuple[float, float]) -> geopandas.GeoDataFrame:
+    #Части обрезки собираются по позициям строк, а исходные метки индекса восстанавливаются в конце
+    positional = df.reset_index(drop=True)
+    clipped, enclosing = split_clipped_contours(positional, left_bottom, right_top)
+    result = pandas.concat([clipped, frame_enclosing_contours([enclosing], left_bottom, right_top, df.crs)]).sort_index(kind='stable')
+    result.index = df.index[result.index]
+    return geopandas.GeoDataFrame(result, crs=df.crs)
+
+'''
+    Первая часть clip_contours: обрезает контуры внутри прямоугольника и пересекающие его и отбрасывает контуры вне его.
+    Возвращает:
+        tuple[geopandas.GeoDataFrame, geopandas.GeoDataFrame] - обрезанные контуры (части одного контура идут подряд, метки индекса исходные)
+                                                                и не изменённые контуры, охватывающие прямоугольник.
+'''
+def split_clipped_contours(df: geopandas.GeoDataFrame, left_bottom: tuple[float, float], right_top: tuple[float, float]) -> tuple[geopandas.GeoDataFrame, geopandas.GeoDataFrame]:
+    box = shapely.box(*left_bottom, *right_top)
+    shapely.prepare(box)
+    rings = np.asarray(df.geometry.array, dtype=object)
+    inside = shapely.contains_properly(box, rings)
+    crossing = ~inside & shapely.intersects(box, rings)
+    #Контур, не пересекающий границу прямоугольника, либо охватывает его целиком, либо лежит вне его
+    around = ~inside & ~crossing
+    around[around] = shapely.contains_xy(_ring_polygons(rings[around]), *left_bottom)
+
+    #Части пересечения областей контуров с прямоугольником (у части пересечения простого полигона с прямоугольником нет дыр).
+    #clip_by_rect ставит вершины на границе точно на стороны прямоугольника, поэтому части вложенных контуров вложены друг в друга.
+    areas = shapely.clip_by_rect(_ring_polygons(rings[crossing]), *left_bottom, *right_top)
+    parts, part_index = shapely.get_parts(areas, return_index=True)
+    polygonal = (shapely.get_type_id(parts) == shapely.GeometryType.POLYGON) & ~shapely.is_empty(parts)
+    parts, part_index = parts[polygonal], part_index[polygonal]
+    coordinates, ring_index = shapely.get_coordinates(shapely.get_exterior_ring(parts), return_index=True)
+    clipped = shapely.linestrings(coordinates, indices=ring_index) if len(parts) else np.empty(0, dtype=object)
+
+    #Строки результата идут в порядке исходных фитч, части одного контура - подряд
+    source = np.concatenate([np.flatnonzero(inside), np.flatnonzero(crossing)[part_index]])
+    geometries = np.concatenate([rings[inside], clipped])
+    order = np.argsort(source, kind='stable')
+    result = df.iloc[source[order]].copy()
+    result['geometry'] = geopandas.GeoSeries(geometries[order], index=result.index, crs=df.crs)
+    return result, df.iloc[np.flatnonzero(around)]
+
+'''
+    Вторая часть clip_contours: заменяет контуры, охватывающие прямоугольник, вложенными друг в друга прямоугольниками чуть больше него
+    (в системе координат crs результата). Контуры передаются группами groups от внутренних к внешним: каждый контур группы охватывает все контуры
+    предыдущих групп, а внутри группы контуры в порядке возрастания площади получают всё большие прямоугольники. Поэтому группу нужно передавать целиком.
+    Группы могут быть в разных системах координат, у результата сохраняются метки индекса и колонки контуров.
+'''
+def frame_enclosing_contours(groups: list[geopandas.GeoDataFrame], left_bottom: tuple[float, float], right_top: tuple[float, float], crs) -> geopandas.GeoDataFrame:
+    rows = pandas.concat([pandas.DataFrame(group.drop(columns=group.geometry.name)) for group in groups])
+    #Ранг контура: номер в порядке площади внутри группы со сдвигом на размер предыдущих групп
+    ranks = np.empty(len(rows), dtype=np.int64)
+    start = 0
+    for group in groups:
+        order = np.argsort(shapely.area(_ring_polygons(np.asarray(group.geometry.array, dtype=object))), kind='stable')
+        ranks[start + order] = start + np.arange(len(group))
+        start += len(group)
+
+    margin = 1e-6 * max(right_top[0] - left_bottom[0], right_top[1] - left_bottom[1], 1)
+    frames = np.empty(len(rows), dtype=object)
+    for i, rank in enumerate(ranks):
+        offset = margin*(rank + 1)
+        frames[i] = shapely.LineString(shapely.box(left_bottom[0] - offset, left_bottom[1] - offset, right_top[0] + offset, right_top[1] + offset).exterior.coords)
+    return geopandas.GeoDataFrame(rows, geometry=geopandas.GeoSeries(frames, index=rows.index, crs=crs), crs=crs)
+
+'''
+    Возвращает области обрезки контуров для сетки с указанными параметрами: область сетки с запасом margin (в единицах crs)
+    и покрывающий её прямоугольник в WGS84 (см. area_clip_bounds).
+'''
+def grid_clip_bounds(leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int, crs: str, margin: float) -> ClipBounds:
+    return area_clip_bounds((leftBottom[0] - margin, leftBottom[1] - margin), (leftBottom[0] + stepSize*columnCount + margin, leftBottom[1] + stepSize*rowCount + margin), crs)
+
+'''
+    Возвращает области обрезки контуров для прямоугольника left_bottom/right_top в crs: сам прямоугольник и покрывающий его прямоугольник в WGS84
+    с дополнительным запасом в восьмую часть большей стороны, чтобы искривление его сторон после проецирования не задевало прямоугольник.
+'''
+def area_clip_bounds(left_bottom: tuple[float, float], right_top: tuple[float, float], crs: str) -> ClipBounds:
+    padding = max(right_top[0] - left_bottom[0], right_top[1] - left_bottom[1])/8
+    bounds = get_transformer(crs, 'EPSG:4326').transform_bounds(
+        left_bottom[0] - padding,
+        left_bottom[1] - padding,
+        right_top[0] + padding,
+        right_top[1] + padding,
+        densify_pts=21,
+    )
+    return ClipBounds(((bounds[0], bounds[1]), (bounds[2], bounds[3])), (left_bottom, right_top))
+
+'''
+    Обрезает контуры df (в WGS84) по областям clip_bounds и проецирует их в crs: до проецирования контуры грубо обрезаются по clip_bounds.wgs84,
+    поэтому проецируются только вершины рядом с сеткой, а после - точно по clip_bounds.projected (см. clip_contours).
+'''
+def clip_and_project(df: geopandas.GeoDataFrame, clip_bounds: ClipBounds, crs: str) -> geopandas.GeoDataFrame:
+    df_projected = project_geometry(clip_contours(df, *clip_bounds.wgs84), crs)
+    return clip_contours(df_projected, *clip_bounds.projected)
+
+'''
+    Полигоны, ограниченные кольцевыми контурами.
+'''
+def _ring_polygons(rings: np.ndarray) -> np.ndarray:
+    if len(rings) == 0:
+        return np.empty(0, dtype=object)
+    coordinates, ring_index = shapely.get_coordinates(rings, return_index=True)
+    return shapely.polygons(shapely.linearrings(coordinates, indices=ring_index))
+
+'''
+    Возвращает прямоугольник в WGS84 (левый нижний и правый верхний углы), покрывающий сетку с указанными параметрами с запасом margin (в единицах crs).
+'''
+def grid_bounds_wgs84(leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int, crs: str, margin: float) -> tuple[tuple[float, float], tuple[float, float]]:
+    bounds = get_transformer(crs, 'EPSG:4326').transform_bounds(
+        leftBottom[0] - margin,
+        leftBottom[1] - margin,
+        leftBottom[0] + stepSize*columnCount + margin,
+        leftBottom[1] + stepSize*rowCount + margin,
+        densify_pts=21,
+    )
+    return (bounds[0], bounds[1]), (bounds[2], bounds[3])
+
+'''
+    Возвращает преобразование координат из from_crs в to_crs (порядок осей x, y). Преобразования кэшируются для каждой пары систем координат,
+    так как их создание занимает заметно больше времени, чем преобразование одной точки.
+'''
+@functools.lru_cache(maxsize=32)
+def get_transformer(from_crs: str | pyproj.CRS, to_crs: str | pyproj.CRS) -> pyproj.Transformer:
+    return pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
 '''
     Создаёт датафрем, в котором основная геометрия приведена к указанной CRS.
 '''
+@profiling.stage('project_geometry', lambda df: {'features': len(df)})
 def project_geometry(df: geopandas.GeoDataFrame, crs: str) -> geopandas.GeoDataFrame:
     return cast(geopandas.GeoDataFrame, df.to_crs(crs))
 
@@ -53,7 +244,7 @@ def project_geometry(df: geopandas.GeoDataFrame, crs: str) -> geopandas.GeoDataF
     Проецирует точку из WGS84 в указанную CRS.
 '''
 def wgs84_point_to_crs(point: tuple[float, float], crs: str) -> tuple[float, float]:
-    return cast(tuple[float, float], pyproj.Transformer.from_crs('EPSG:4326', crs, always_xy=True,).transform(*point, errcheck=True))
+    return cast(tuple[float, float], get_transformer('EPSG:4326', crs).transform(*point, errcheck=True))
 
 '''
     Создаёт сетку для сэмплирования высот с указанными параметрами в системе координат с осью x направленной вправо, осью y направленной вверх.
@@ -69,6 +260,7 @@ def wgs84_point_to_crs(point: tuple[float, float], crs: str) -> tuple[float, flo
             'leftDownIndex' : int - индекс точки сэмплирования в направлении слева-направо, сверху-вниз.
                                     Точка в левом верхнем углу имеет индекс 0, в конце первой строки columnCount - 1, в начале второй строки columnCount, в правом нижнем углу - rowCount*columnCount-1
 '''
+@profiling.stage('generate_sampling_grid', lambda df: {'cells': len(df)})
 def generate_sampling_grid(leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int, crs: str) -> geopandas.GeoDataFrame:
     if columnCount < 1:
         raise ValueError('columnCount should be greater than 0')
@@ -89,6 +281,7 @@ def generate_sampling_grid(leftBottom: tuple[int, int], stepSize: int, columnCou
     Задаёт каждой точке из sampling_grid значение высоты на основе геометрии фитч terrain.
     В случае конфликта (попадания на границу двух фитч) точке присваивается наибольшая высота.
 '''
+@profiling.stage('generate_height_map', lambda df: {'cells': len(df), 'nodata_cells': int(df['elevation'].isna().sum())})
 def generate_height_map(terrain: geopandas.GeoDataFrame, sampling_grid: geopandas.GeoDataFrame) -> geopandas.GeoDataFrame:
     terrain_internal = terrain.copy()
     #Необходимо немного расширить геометрии, чтобы границы геометрий лежали друг в друге, т.к. предикат within объединяет геометрии, только если одна полностью лежит в другой, не касаясь границ
@@ -105,18 +298,19 @@ def generate_height_map(terrain: geopandas.GeoDataFrame, sampling_grid: geopanda
     df_joined.drop(['index_right'], axis=1, inplace=True)
     return df_joined
 
+'''
+    Преобразовывает карту высот из GeoDataFrame (результат generate_height_map) в двумерный массив,
+    где первый индекс определяет строку (0 - верхняя строка сетки), а второй - столбец.
+'''
+def height_map_to_array(heightMap: geopandas.GeoDataFrame) -> np.ndarray:
+    ys = cast(geopandas.GeoSeries, heightMap['point']).y.to_numpy()
+    #Строки сетки идут подряд, поэтому число столбцов - это позиция первой смены y
+    breaks = np.flatnonzero(ys[1:] != ys[:-1])
+    columnCount = int(breaks[0]) + 1 if len(breaks) > 0 else len(ys)
+    return heightMap['elevation'].to_numpy(dtype=np.float64).reshape(-1, columnCount)
+
 '''
     Преобразовывает карту высот из GeoDataFrame в список списков, где индекс внешнего списка определяет строку, а внутреннего - столбец.
 '''
 def height_map_to_lists(heightMap: geopandas.GeoDataFrame) -> list[list[float]]:
-    out = []
-    curY = heightMap.iloc[0]['point'].y
-    curList : list[float] = []
-    for i, row in heightMap.iterrows():
-        if row['point'].y != curY:
-            out.append(curList)
-            curList = []
-            curY = row['point'].y
-        curList.append(row['elevation'])
-    out.append(curList)
-    return out
\ No newline at end of file
+    return height_map_to_array(heightMap).tolist()
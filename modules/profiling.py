@@ -0,0 +1,167 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+from typing import Callable
+
+try:
+    import resource
+except ImportError:
+    #Модуль resource недоступен в Windows, пиковый RSS тогда не записывается
+    resource = None
+
+'''
+    Сборщик метрик этапов конвейера. Пока сборщик не запущен (start), декорированные этапы вызываются напрямую
+    и count ничего не делает, поэтому инструментирование не влияет на обычные запуски.
+    Для каждого этапа записываются время wall и CPU, RSS до и после этапа, пиковый RSS во время этапа и счётчики элементов.
+    Пиковый RSS этапа измеряется сбросом пика процесса перед этапом (reset_peak_rss, только Linux), поэтому пик вложенного этапа
+    учитывается и в пиках охватывающих этапов, а пик всего процесса отслеживается отдельно. Если сброс недоступен, пик этапа не записывается.
+'''
+class StageRecorder:
+    def __init__(self, profile: bool = False):
+        self.stages : list[dict] = []
+        self.stack : list[dict] = []
+        #Наибольший RSS, наблюдавшийся в каждом выполняющемся этапе до последнего сброса пика
+        self.peaks : list[int] = []
+        self.process_peak = peak_rss() or 0
+        self.started = time.perf_counter()
+        self.profiler = cProfile.Profile() if profile else None
+
+    '''
+        Выполняет func как этап name и записывает его метрики. counter вычисляет счётчики элементов по результату этапа.
+    '''
+    def run(self, name: str, counter: Callable | None, func: Callable, args: tuple, kwargs: dict):
+        record = {'stage': name, 'parent': self.stack[-1]['stage'] if self.stack else None, 'counts': {}, 'rss_before_bytes': current_rss()}
+        #Пик с последнего сброса принадлежит всем выполняющимся этапам, после чего пик сбрасывается для нового этапа
+        self._observe_peak()
+        resettable = reset_peak_rss()
+        self.stack.append(record)
+        self.peaks.append(0)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.process_time() - cpu_start
+            record['rss_after_bytes'] = current_rss()
+            self._observe_peak()
+            peak = self.peaks.pop()
+            record['peak_rss_bytes'] = peak if resettable else None
+            self.stack.pop()
+            self.stages.append(record)
+        if counter is not None:
+            record['counts'].update(counter(result))
+        return result
+
+    '''
+        Формирует отчёт: этапы в порядке завершения и суммарное время по имени этапа.
+    '''
+    def report(self) -> dict:
+        totals : dict[str, dict] = {}
+        for record in self.stages:
+            total = totals.setdefault(record['stage'], {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0})
+            total['calls'] += 1
+            total['wall_s'] += record['wall_s']
+            total['cpu_s'] += record['cpu_s']
+        self._observe_peak()
+        return {
+            'wall_s': time.perf_counter() - self.started,
+            'peak_rss_bytes': self.process_peak or None,
+            'stages': self.stages,
+            'totals': totals,
+        }
+
+    '''
+        Учитывает пиковый RSS с последнего сброса в пиках выполняющихся этапов и в пике процесса.
+    '''
+    def _observe_peak(self):
+        peak = peak_rss() or 0
+        self.peaks = [max(value, peak) for value in self.peaks]
+        self.process_peak = max(self.process_peak, peak)
+
+_active : StageRecorder | None = None
+
+'''
+    Включает сбор метрик этапов. При profile=True дополнительно включается cProfile.
+'''
+def start(profile: bool = False) -> StageRecorder:
+    global _active
+    _active = StageRecorder(profile)
+    if _active.profiler is not None:
+        _active.profiler.enable()
+    return _active
+
+'''
+    Выключает сбор метрик и возвращает отчёт. Если задан path, отчёт записывается в него в формате JSON,
+    а статистика cProfile (если она собиралась) - в файл с тем же именем и расширением .prof.
+'''
+def stop(path: str | None = None) -> dict:
+    global _active
+    recorder, _active = _active, None
+    if recorder is None:
+        return {}
+    if recorder.profiler is not None:
+        recorder.profiler.disable()
+    report = recorder.report()
+    if path is not None:
+        if recorder.profiler is not None:
+            report['cprofile'] = os.path.splitext(path)[0] + '.prof'
+            recorder.profiler.dump_stats(report['cprofile'])
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    return report
+
+'''
+    Декоратор этапа конвейера. counter получает результат этапа и возвращает словарь счётчиков элементов.
+'''
+def stage(name: str, counter: Callable | None = None) -> Callable:
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            return _active.run(name, counter, func, args, kwargs)
+        return wrapper
+    return decorator
+
+'''
+    Добавляет value к счётчику name текущего этапа. Ничего не делает, если сбор метрик выключен или этап не выполняется.
+'''
+def count(name: str, value: int):
+    if _active is not None and _active.stack:
+        counts = _active.stack[-1]['counts']
+        counts[name] = counts.get(name, 0) + int(value)
+
+'''
+    Возвращает пиковый RSS процесса в байтах (с запуска или с последнего reset_peak_rss) или None, если он недоступен.
+'''
+def peak_rss() -> int | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux возвращает килобайты, macOS - байты
+    return peak if sys.platform == 'darwin' else peak*1024
+
+'''
+    Возвращает текущий RSS процесса в байтах или None, если он недоступен (только Linux).
+'''
+def current_rss() -> int | None:
+    try:
+        with open('/proc/self/statm', encoding='ascii') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+'''
+    Сбрасывает пиковый RSS процесса до текущего RSS (запись 5 в /proc/self/clear_refs, Linux), чтобы peak_rss возвращал пик
+    с момента сброса. Сбрасывается и ru_maxrss. Возвращает False, если сброс недоступен.
+'''
+def reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,155 @@
+import geopandas
+import numpy as np
+import shapely
+from typing import cast
+from modules import profiling
+from modules.processing import GridGeoreference
+
+'''
+    Адаптивный вариант generate_height_map: сетка рекурсивно делится на блоки (квадродерево), и каждый блок проверяется
+    против полигонов целиком. Блок, который все пересекающие его полигоны выше наивысшего из содержащих его строго внутри (contains_properly)
+    не пересекают, заполняется высотой этого полигона (или остаётся nan) за один шаг. Делятся дальше только блоки, через которые проходит
+    граница более высокого полигона, а блоки не больше leafSize x leafSize ячеек проверяются по отдельным ячейкам (contains_xy).
+    Поэтому объём работы растёт с суммарной длиной контуров, а не с числом ячеек.
+    Соглашения и результат совпадают с generate_sampling_grid/generate_height_map:
+        - значение ячейки берётся в её центре (левый нижний угол + stepSize//2);
+        - полигоны расширяются на 1 метр (buffer(1)), центр на границе полигона в него не попадает (предикат within);
+        - при попадании ячейки в несколько полигонов ей присваивается наибольшая высота;
+        - ячейки вне всех полигонов имеют значение nan.
+    Аргументы:
+        terrain : geopandas.GeoDataFrame - полигоны высот (результат contours_to_polygons) в системе координат crs.
+        leftBottom : tuple[int, int] - левый нижний угол сетки.
+        stepSize : int - шаг сетки.
+        columnCount : int - число столбцов сетки.
+        rowCount : int - число строк сетки.
+        crs : str - система координат сетки.
+        leafSize : int - наибольшая сторона блока (в ячейках), ячейки которого проверяются по отдельности.
+    Возвращает:
+        tuple[np.ndarray, GridGeoreference] - массив высот формы (rowCount, columnCount), где строка 0 - верхняя (северная) строка сетки,
+                                              и геопривязка этого массива.
+'''
+@profiling.stage('quadtree_height_map', lambda result: {'cells': result[0].size, 'nodata_cells': int(np.isnan(result[0]).sum())})
+def quadtree_height_map(terrain: geopandas.GeoDataFrame, leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int, crs: str, leafSize: int = 8) -> tuple[np.ndarray, GridGeoreference]:
+    if columnCount < 1:
+        raise ValueError('columnCount should be greater than 0')
+    elif rowCount < 1:
+        raise ValueError('rowCount should be greater than 0')
+    elif stepSize < 1:
+        raise ValueError('stepSize should be greater than 0')
+    elif leafSize < 1:
+        raise ValueError('leafSize should be greater than 0')
+
+    #Строки массива здесь считаются снизу, в конце массив переворачивается
+    heights = np.full((rowCount, columnCount), np.nan, dtype=np.float64)
+    #Координаты центра левой нижней ячейки
+    origin = (leftBottom[0] + stepSize//2, leftBottom[1] + stepSize//2)
+
+    #Полигоны, ограничивающий прямоугольник которых (с учётом расширения на 1 метр) не достаёт до центров ячеек, не влияют на результат
+    bounds = shapely.bounds(cast(geopandas.GeoSeries, terrain['geometry']).to_numpy())
+    near = ((bounds[:, 0] < origin[0] + (columnCount - 1)*stepSize + 1) & (bounds[:, 2] > origin[0] - 1) &
+            (bounds[:, 1] < origin[1] + (rowCount - 1)*stepSize + 1) & (bounds[:, 3] > origin[1] - 1))
+    #Так же, как и перед sjoin, расширяем геометрии, чтобы соседние полигоны перекрывались по общей границе
+    geometries = cast(geopandas.GeoSeries, terrain['geometry'][near]).buffer(1).to_numpy()
+    elevations = terrain['elevation'].to_numpy(dtype=np.float64)[near]
+    shapely.prepare(geometries)
+
+    #Блоки текущего уровня (начало и конец диапазонов строк и столбцов) и их "пол" - наибольшая высота полигона,
+    #строго содержащего весь блок (-inf, если такого нет). Пары (блок, полигон) - полигоны выше пола, которые могут пересекать блок.
+    blocks = np.array([[0, rowCount, 0, columnCount]], dtype=np.int64)
+    floor = np.array([-np.inf])
+    pair_block, pair_geometry = np.zeros(len(geometries), dtype=np.int64), np.arange(len(geometries))
+    filled = 0
+    while len(blocks):
+        row_start, row_end, column_start, column_end = blocks.T
+        boxes = _block_boxes(blocks, origin, stepSize)
+        #Полигоны подготовлены (prepared), поэтому пересечение проверяется по индексу их рёбер, а не перебором всех вершин
+        intersecting = shapely.intersects(geometries[pair_geometry], boxes[pair_block])
+        pair_block, pair_geometry = pair_block[intersecting], pair_geometry[intersecting]
+
+        #Полигоны, строго содержащие весь блок, поднимают его пол, а полигоны не выше пола на значения ячеек блока уже не влияют
+        containing = shapely.contains_properly(geometries[pair_geometry], boxes[pair_block])
+        np.maximum.at(floor, pair_block[containing], elevations[pair_geometry[containing]])
+        above = ~containing & (elevations[pair_geometry] > floor[pair_block])
+        pair_block, pair_geometry = pair_block[above], pair_geometry[above]
+
+        #Блок без оставшихся полигонов заполняется своим полом целиком, как и лист перед проверкой отдельных ячеек
+        crossing = np.bincount(pair_block, minlength=len(blocks)) > 0
+        leaf = crossing & (row_end - row_start <= leafSize) & (column_end - column_start <= leafSize)
+        for i in np.flatnonzero(~crossing | leaf):
+            if floor[i] > -np.inf:
+                heights[row_start[i]:row_end[i], column_start[i]:column_end[i]] = floor[i]
+        filled += int((~crossing).sum())
+        if leaf.any():
+            in_leaf = leaf[pair_block]
+            _sample_leaves(heights, blocks, pair_block[in_leaf], pair_geometry[in_leaf], geometries, elevations, origin, stepSize)
+
+        #Остальные блоки делятся, и их части наследуют пол и полигоны родителя
+        split = crossing & ~leaf
+        in_split = split[pair_block]
+        pair_block, pair_geometry = pair_block[in_split], pair_geometry[in_split]
+        renumber = np.cumsum(split) - 1
+        blocks, parent = _split_blocks(blocks[split])
+        floor = floor[split][parent]
+        #Пары отсортированы по блоку, части одного блока идут подряд: каждая пара повторяется для всех частей своего блока
+        parent_block = renumber[pair_block]
+        child_count = np.bincount(parent, minlength=int(split.sum()))
+        child_start = np.cumsum(child_count) - child_count
+        repeats = child_count[parent_block]
+        offset = np.arange(int(repeats.sum())) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        pair_block = np.repeat(child_start[parent_block], repeats) + offset
+        pair_geometry = np.repeat(pair_geometry, repeats)
+        order = np.argsort(pair_block, kind='stable')
+        pair_block, pair_geometry = pair_block[order], pair_geometry[order]
+
+    profiling.count('filled_blocks', filled)
+    return heights[::-1].copy(), GridGeoreference((leftBottom[0], leftBottom[1]), stepSize, columnCount, rowCount, crs)
+
+'''
+    Прямоугольники центров ячеек блоков. Запас в четверть шага делает прямоугольник невырожденным для блоков в одну строку или столбец
+    и не меняет результат: проверки прямоугольника с запасом только строже проверок самих центров.
+'''
+def _block_boxes(blocks: np.ndarray, origin: tuple[float, float], stepSize: int) -> np.ndarray:
+    row_start, row_end, column_start, column_end = blocks.T
+    margin = stepSize / 4
+    return shapely.box(
+        origin[0] + column_start*stepSize - margin,
+        origin[1] + row_start*stepSize - margin,
+        origin[0] + (column_end - 1)*stepSize + margin,
+        origin[1] + (row_end - 1)*stepSize + margin,
+    )
+
+'''
+    Проверяет по отдельности ячейки листовых блоков: ячейке присваивается наибольшая высота из полигонов пар (блок, полигон),
+    которые содержат её центр, если она выше уже записанной высоты блока.
+'''
+def _sample_leaves(heights: np.ndarray, blocks: np.ndarray, pair_block: np.ndarray, pair_geometry: np.ndarray,
+                   geometries: np.ndarray, elevations: np.ndarray, origin: tuple[float, float], stepSize: int):
+    row_start, row_end, column_start, column_end = blocks[pair_block].T
+    width = column_end - column_start
+    counts = (row_end - row_start) * width
+    #Развёртываем каждую пару (блок, полигон) в пары (ячейка блока, полигон)
+    pair = np.repeat(np.arange(len(counts)), counts)
+    cell = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows = row_start[pair] + cell // width[pair]
+    columns = column_start[pair] + cell % width[pair]
+    contained = shapely.contains_xy(geometries[pair_geometry[pair]], origin[0] + columns*stepSize, origin[1] + rows*stepSize)
+    flat = heights.reshape(-1)
+    np.fmax.at(flat, (rows*heights.shape[1] + columns)[contained], elevations[pair_geometry[pair]][contained])
+
+'''
+    Делит каждый блок пополам по строкам и по столбцам (если в блоке больше одной строки или столбца).
+    Возвращает части блоков, упорядоченные по родительскому блоку, и индекс родителя каждой части.
+'''
+def _split_blocks(blocks: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    row_start, row_end, column_start, column_end = blocks.T
+    row_middle = (row_start + row_end + 1) // 2
+    column_middle = (column_start + column_end + 1) // 2
+    children = np.stack([
+        np.stack([row_start, row_middle, column_start, column_middle], axis=1),
+        np.stack([row_start, row_middle, column_middle, column_end], axis=1),
+        np.stack([row_middle, row_end, column_start, column_middle], axis=1),
+        np.stack([row_middle, row_end, column_middle, column_end], axis=1),
+    ], axis=1).reshape(-1, 4)
+    parent = np.repeat(np.arange(len(blocks)), 4)
+    keep = (children[:, 0] < children[:, 1]) & (children[:, 2] < children[:, 3])
+    return children[keep], parent[keep]
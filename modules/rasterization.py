@@ -0,0 +1,179 @@
+import geopandas
+import numpy as np
+import shapely
+from typing import cast
+from modules import profiling
+from modules.processing import GridGeoreference
+
+'''
+    Растровый вариант generate_height_map: вместо создания точки для каждой ячейки и пространственного объединения
+    полигоны terrain "прожигаются" напрямую в заранее выделенный массив высот построчным (scanline) заполнением по правилу чётности.
+    Соглашения совпадают с generate_sampling_grid/generate_height_map:
+        - значение ячейки берётся в её центре (левый нижний угол + stepSize//2);
+        - полигоны расширяются на 1 метр (buffer(1)), как и перед sjoin, центр на границе полигона в него не попадает (предикат within);
+        - при попадании ячейки в несколько полигонов ей присваивается наибольшая высота;
+        - ячейки вне всех полигонов имеют значение nan.
+    Аргументы:
+        terrain : geopandas.GeoDataFrame - полигоны высот (результат contours_to_polygons) в системе координат crs.
+        leftBottom : tuple[int, int] - левый нижний угол сетки.
+        stepSize : int - шаг сетки.
+        columnCount : int - число столбцов сетки.
+        rowCount : int - число строк сетки.
+        crs : str - система координат сетки.
+    Возвращает:
+        tuple[np.ndarray, GridGeoreference] - массив высот формы (rowCount, columnCount), где строка 0 - верхняя (северная) строка сетки,
+                                              и геопривязка этого массива.
+'''
+@profiling.stage('rasterize_height_map', lambda result: {'cells': result[0].size, 'nodata_cells': int(np.isnan(result[0]).sum())})
+def rasterize_height_map(terrain: geopandas.GeoDataFrame, leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int, crs: str) -> tuple[np.ndarray, GridGeoreference]:
+    if columnCount < 1:
+        raise ValueError('columnCount should be greater than 0')
+    elif rowCount < 1:
+        raise ValueError('rowCount should be greater than 0')
+    elif stepSize < 1:
+        raise ValueError('stepSize should be greater than 0')
+
+    heights = np.full((rowCount, columnCount), np.nan, dtype=np.float64)
+    #Координаты центра левой нижней ячейки
+    origin = (leftBottom[0] + stepSize//2, leftBottom[1] + stepSize//2)
+
+    #Так же, как и перед sjoin, расширяем геометрии, чтобы соседние полигоны перекрывались по общей границе
+    buffered = cast(geopandas.GeoSeries, terrain['geometry']).buffer(1)
+    burn_polygons(heights, buffered.to_numpy(), terrain['elevation'].to_numpy(), origin, stepSize)
+
+    return heights, GridGeoreference((leftBottom[0], leftBottom[1]), stepSize, columnCount, rowCount, crs)
+
+'''
+    Прожигает геометрии geometries с высотами elevations в массив heights (см. burn_polygon).
+    Геометрии должны быть уже расширены на 1 метр. Ячейке, попавшей в несколько геометрий, присваивается наибольшая высота.
+'''
+def burn_polygons(heights: np.ndarray, geometries: np.ndarray, elevations: np.ndarray, origin: tuple[float, float], stepSize: int):
+    #Полигоны прожигаются по возрастанию высоты, поэтому для разрешения конфликтов достаточно np.fmax
+    order = np.argsort(elevations, kind='stable')
+    for i in order:
+        burn_polygon(heights, geometries[i], float(elevations[i]), origin, stepSize)
+
+'''
+    Записывает высоту elevation во все ячейки массива heights, центры которых лежат внутри geometry (Polygon или MultiPolygon).
+    Ячейки, уже имеющие большую высоту, не изменяются.
+    Аргументы:
+        heights : np.ndarray - массив высот (строка 0 - верхняя строка сетки), изменяется на месте.
+        geometry : shapely.Geometry - прожигаемая геометрия.
+        elevation : float - высота геометрии.
+        origin : tuple[float, float] - координаты центра левой нижней ячейки массива.
+        stepSize : int - шаг сетки.
+'''
+def burn_polygon(heights: np.ndarray, geometry: shapely.Geometry, elevation: float, origin: tuple[float, float], stepSize: int):
+    window = polygon_mask(geometry, origin, stepSize, heights.shape[1], heights.shape[0])
+    if window is None:
+        return
+    rows, columns, mask = window
+    target = heights[rows, columns]
+    heights[rows, columns] = np.where(mask, np.fmax(target, elevation), target)
+
+'''
+    Строит маску ячеек, центры которых лежат внутри geometry, в пределах ограничивающего прямоугольника геометрии.
+    Все кольца (внешние и внутренние) всех частей геометрии обрабатываются вместе по правилу чётности,
+    поэтому дыры вырезаются автоматически.
+    Возвращает:
+        tuple[slice, slice, np.ndarray] | None - срезы строк и столбцов массива высот (строка 0 - верхняя) и маска для этого окна,
+                                                 либо None, если геометрия не покрывает ни одной ячейки.
+'''
+def polygon_mask(geometry: shapely.Geometry, origin: tuple[float, float], stepSize: int, columnCount: int, rowCount: int) -> tuple[slice, slice, np.ndarray] | None:
+    if geometry is None or geometry.is_empty:
+        return None
+
+    #Окно ячеек, центры которых попадают в ограничивающий прямоугольник геометрии
+    min_x, min_y, max_x, max_y = geometry.bounds
+    col_start = max(int(np.ceil((min_x - origin[0]) / stepSize)), 0)
+    col_end = min(int(np.floor((max_x - origin[0]) / stepSize)) + 1, columnCount)
+    row_start = max(int(np.ceil((min_y - origin[1]) / stepSize)), 0)
+    row_end = min(int(np.floor((max_y - origin[1]) / stepSize)) + 1, rowCount)
+    if col_start >= col_end or row_start >= row_end:
+        return None
+
+    #Рёбра всех колец геометрии
+    rings = shapely.get_rings(shapely.get_parts(geometry))
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+    #Ребро соединяет соседние вершины одного кольца
+    same_ring = ring_index[1:] == ring_index[:-1]
+    start = coords[:-1][same_ring]
+    end = coords[1:][same_ring]
+
+    #Ребро пересекает строку k (считая снизу), если y строки лежит в полуинтервале [min(y1, y2), max(y1, y2)).
+    #Полуинтервал гарантирует, что каждая строка пересекает замкнутое кольцо чётное число раз.
+    low_y = np.minimum(start[:, 1], end[:, 1])
+    high_y = np.maximum(start[:, 1], end[:, 1])
+    first_row = np.clip(np.ceil((low_y - origin[1]) / stepSize), row_start, row_end).astype(np.int64)
+    last_row = np.clip(np.ceil((high_y - origin[1]) / stepSize), row_start, row_end).astype(np.int64)
+    counts = last_row - first_row
+    total = int(counts.sum())
+    if total == 0:
+        return None
+
+    #Развёртываем каждое ребро в список пересекаемых им строк
+    edge = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    crossing_row = first_row[edge] + (np.arange(total) - offsets[edge])
+    y = origin[1] + crossing_row * stepSize
+    x = start[edge, 0] + (y - start[edge, 1]) * (end[edge, 0] - start[edge, 0]) / (end[edge, 1] - start[edge, 1])
+
+    #Сортировка пересечений по строке, а внутри строки - по x. Соседние пары пересечений ограничивают внутренние отрезки строки.
+    order = np.lexsort((x, crossing_row))
+    row = crossing_row[order][0::2] - row_start
+    enter = x[order][0::2]
+    leave = x[order][1::2]
+
+    #Ячейка c внутри отрезка, если enter <= x центра < leave
+    width = col_end - col_start
+    enter_col = np.clip(np.ceil((enter - origin[0]) / stepSize) - col_start, 0, width).astype(np.int64)
+    leave_col = np.clip(np.ceil((leave - origin[0]) / stepSize) - col_start, 0, width).astype(np.int64)
+
+    #Разностный массив: +1 в начале отрезка, -1 после его конца, накопленная сумма по строке даёт маску
+    size = (row_end - row_start) * (width + 1)
+    delta = np.bincount(row * (width + 1) + enter_col, minlength=size) - np.bincount(row * (width + 1) + leave_col, minlength=size)
+    mask = np.cumsum(delta.reshape(row_end - row_start, width + 1), axis=1)[:, :width] > 0
+
+    #Центр на границе геометрии, как и для предиката within в sjoin, не лежит внутри неё, но правило чётности может его засчитать
+    boundary_rows, boundary_columns = _boundary_cells(crossing_row, x, start, end, origin, stepSize, row_start, row_end, col_start, col_end)
+    if len(boundary_rows):
+        mask[boundary_rows, boundary_columns] = shapely.contains_xy(geometry, origin[0] + (boundary_columns + col_start)*stepSize,
+                                                                    origin[1] + (boundary_rows + row_start)*stepSize)
+
+    #Строки маски считаются снизу, а строки массива высот - сверху
+    return slice(rowCount - row_end, rowCount - row_start), slice(col_start, col_end), mask[::-1]
+
+'''
+    Ячейки окна (строки считаются снизу), центры которых могут лежать на границе геометрии: строка пересекает ребро точно в центре ячейки
+    (в том числе в вершине или на вертикальном ребре) или ребро горизонтально и лежит на строке. Такие ячейки перепроверяются по самой геометрии.
+    Совпадение проверяется с небольшим допуском: лишняя перепроверка не меняет результат.
+'''
+def _boundary_cells(crossing_row: np.ndarray, x: np.ndarray, start: np.ndarray, end: np.ndarray, origin: tuple[float, float], stepSize: int,
+                    row_start: int, row_end: int, col_start: int, col_end: int) -> tuple[np.ndarray, np.ndarray]:
+    tolerance = 1e-9
+    #Пересечения строк с рёбрами в центрах ячеек
+    position = (x - origin[0]) / stepSize
+    column = np.rint(position)
+    on_centre = (np.abs(position - column) <= tolerance) & (column >= col_start) & (column < col_end)
+    rows = [crossing_row[on_centre]]
+    columns = [column[on_centre].astype(np.int64)]
+
+    #Горизонтальные рёбра на строках: строки их не пересекают, поэтому все центры на ребре перепроверяются
+    y_position = (start[:, 1] - origin[1]) / stepSize
+    edge_row = np.rint(y_position)
+    flat = ((start[:, 1] == end[:, 1]) & (np.abs(y_position - edge_row) <= tolerance) & (edge_row >= row_start) & (edge_row < row_end))
+    if flat.any():
+        low_x = (np.minimum(start[flat, 0], end[flat, 0]) - origin[0]) / stepSize
+        high_x = (np.maximum(start[flat, 0], end[flat, 0]) - origin[0]) / stepSize
+        first_column = np.clip(np.ceil(low_x - tolerance), col_start, col_end).astype(np.int64)
+        last_column = np.clip(np.floor(high_x + tolerance) + 1, col_start, col_end).astype(np.int64)
+        counts = np.maximum(last_column - first_column, 0)
+        edge = np.repeat(np.arange(len(counts)), counts)
+        rows.append(edge_row[flat].astype(np.int64)[edge])
+        columns.append(first_column[edge] + (np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)))
+
+    rows, columns = np.concatenate(rows), np.concatenate(columns)
+    if len(rows) == 0:
+        return rows, columns
+    cells = np.unique((rows - row_start) * (col_end - col_start) + (columns - col_start))
+    return cells // (col_end - col_start), cells % (col_end - col_start)
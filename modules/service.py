@@ -0,0 +1,372 @@
+import asyncio
+import functools
+import io
+import json
+import numpy as np
+import shapely
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Final, Hashable
+from urllib.parse import parse_qs, urlsplit
+from modules.jobs import SharedTerrain
+from modules.processing import GridGeoreference, grid_bounds_wgs84, wgs84_point_to_crs
+from modules.rasterization import burn_polygons
+from modules.writers import dump_ascii_grid
+
+#Форматы ответа сервиса: ESRI ASCII grid и массив NumPy (.npy, float32)
+SERVICE_FORMATS : Final[dict[str, str]] = {'asc': 'text/plain; charset=utf-8', 'npy': 'application/octet-stream'}
+
+'''
+    Кэш, ограниченный суммарным размером значений: при превышении size_limit вытесняются давно не использованные записи.
+    Размер каждого значения передаётся в put. Считает попадания и промахи get.
+'''
+class LRUCache:
+    def __init__(self, size_limit: int):
+        self.size_limit = size_limit
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries : OrderedDict[Hashable, tuple[object, int]] = OrderedDict()
+
+    def get(self, key: Hashable):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: Hashable, value, size: int):
+        #Значение больше всего кэша не сохраняется, чтобы не вытеснять всё остальное
+        if size > self.size_limit:
+            return
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self.size += size
+        while self.size > self.size_limit:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'size_limit': self.size_limit,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': _hit_rate(self.hits, self.misses),
+        }
+
+'''
+    Полигоны высот, уже расширенные на 1 метр, с кэшем тайлов: плоскость делится на квадраты tileSize x tileSize (в единицах crs),
+    и для каждого квадрата хранятся полигоны, обрезанные по нему с запасом (shapely.clip_by_rect).
+    Карта высот строится по тайлам: ячейки, центры которых лежат в квадрате, заполняются только его обрезанными полигонами,
+    поэтому время построения зависит от размера окна, а не от размера исходных полигонов, и тайлы переиспользуются
+    перекрывающимися запросами с любым шагом сетки. Результат совпадает с rasterize_height_map.
+    Аргументы конструктора:
+        geometries : np.ndarray - полигоны высот, расширенные на 1 метр.
+        elevations : np.ndarray - высоты полигонов.
+        tileSize : int - сторона тайла в единицах crs.
+        size_limit : int - ограничение суммарного размера кэша тайлов в байтах.
+'''
+class TiledTerrain:
+    def __init__(self, geometries: np.ndarray, elevations: np.ndarray, tileSize: int, size_limit: int):
+        if tileSize < 1:
+            raise ValueError('tileSize should be greater than 0')
+        self.geometries = geometries
+        self.elevations = elevations
+        self.index = shapely.STRtree(geometries)
+        self.tile_size = tileSize
+        self.tiles = LRUCache(size_limit)
+
+    '''
+        Возвращает полигоны тайла (tx, ty), обрезанные по квадрату тайла, расширенному на 1, и их высоты.
+    '''
+    def tile(self, tx: int, ty: int) -> tuple[np.ndarray, np.ndarray]:
+        cached = self.tiles.get((tx, ty))
+        if cached is not None:
+            return cached
+        rect = (tx*self.tile_size - 1, ty*self.tile_size - 1, (tx + 1)*self.tile_size + 1, (ty + 1)*self.tile_size + 1)
+        candidates = self.index.query(shapely.box(*rect))
+        clipped = shapely.clip_by_rect(self.geometries[candidates], *rect)
+        keep = ~shapely.is_empty(clipped)
+        tile = (clipped[keep], self.elevations[candidates][keep])
+        #Оценка занимаемой памяти: 16 байт на вершину и накладные расходы на объект геометрии
+        self.tiles.put((tx, ty), tile, int(shapely.get_num_coordinates(tile[0]).sum())*16 + len(tile[0])*128)
+        return tile
+
+    '''
+        Строит карту высот сетки с указанными параметрами (соглашения - как у rasterize_height_map).
+    '''
+    def sample(self, leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int) -> np.ndarray:
+        heights = np.full((rowCount, columnCount), np.nan, dtype=np.float64)
+        #Координаты центра левой нижней ячейки. Все координаты здесь целые, поэтому деление на тайлы точное.
+        origin = (leftBottom[0] + stepSize//2, leftBottom[1] + stepSize//2)
+        size = self.tile_size
+        for ty in range(origin[1]//size, (origin[1] + (rowCount - 1)*stepSize)//size + 1):
+            #Строки (считая снизу), центры которых лежат в [ty*size, (ty + 1)*size)
+            row_start = max(-((origin[1] - ty*size)//stepSize), 0)
+            row_end = min(-((origin[1] - (ty + 1)*size)//stepSize), rowCount)
+            if row_start >= row_end:
+                continue
+            for tx in range(origin[0]//size, (origin[0] + (columnCount - 1)*stepSize)//size + 1):
+                column_start = max(-((origin[0] - tx*size)//stepSize), 0)
+                column_end = min(-((origin[0] - (tx + 1)*size)//stepSize), columnCount)
+                if column_start >= column_end:
+                    continue
+                geometries, elevations = self.tile(tx, ty)
+                if len(geometries) == 0:
+                    continue
+                #Окно массива высот (строка 0 - верхняя) и центр его левой нижней ячейки
+                window = heights[rowCount - row_end:rowCount - row_start, column_start:column_end]
+                burn_polygons(window, geometries, elevations, (origin[0] + column_start*stepSize, origin[1] + row_start*stepSize), stepSize)
+        return heights
+
+#Данные процесса пула HeightMapService
+_worker_terrain : TiledTerrain | None = None
+
+def _init_worker(wkb: np.ndarray, elevations: np.ndarray, tileSize: int, size_limit: int):
+    global _worker_terrain
+    _worker_terrain = TiledTerrain(shapely.from_wkb(wkb), elevations, tileSize, size_limit)
+
+def _sample_in_worker(leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int) -> tuple[np.ndarray, int, int]:
+    assert _worker_terrain is not None
+    hits, misses = _worker_terrain.tiles.hits, _worker_terrain.tiles.misses
+    heights = _worker_terrain.sample(leftBottom, stepSize, columnCount, rowCount)
+    return heights, _worker_terrain.tiles.hits - hits, _worker_terrain.tiles.misses - misses
+
+'''
+    Долгоживущий HTTP сервис карт высот поверх SharedTerrain.
+    Контуры и полигоны высот загружаются один раз при запуске. Полигоны, расширенные на 1 метр, передаются в пул процессов,
+    где и выполняется сэмплирование, чтобы цикл событий оставался отзывчивым. Каждый процесс хранит LRU кэш тайлов полигонов (TiledTerrain),
+    а сервис - LRU кэш готовых карт высот. Одинаковые запросы, пришедшие одновременно, вычисляются один раз.
+    Запросы:
+        GET /heightmap?bbox=<lon>,<lat>,<lon>,<lat>&step_size=<м>&rows=<число>&cols=<число>[&format=asc|npy]
+            Левый нижний угол bbox (WGS84), спроецированный в crs, задаёт левый нижний угол сетки, как в main.py.
+            bbox должен лежать внутри загруженного региона. Геопривязка возвращается в заголовке X-Georeference.
+        GET /stats - задержки запросов и доля попаданий в кэши (JSON).
+    Аргументы конструктора:
+        terrain : SharedTerrain - контуры загруженного региона.
+        crs : str - система координат сеток.
+        workers : int | None - число процессов (по умолчанию - число ядер).
+        tileSize : int - сторона тайла полигонов в единицах crs.
+        result_cache_size : int - ограничение размера кэша карт высот в байтах.
+        tile_cache_size : int - ограничение размера кэша тайлов одного процесса в байтах.
+        max_cells : int - наибольшее число ячеек сетки в одном запросе.
+'''
+class HeightMapService:
+    def __init__(self, terrain: SharedTerrain, crs: str, workers: int | None = None, tileSize: int = 10000,
+                 result_cache_size: int = 256*1024**2, tile_cache_size: int = 256*1024**2, max_cells: int = 25_000_000):
+        self.terrain = terrain
+        self.crs = crs
+        self.workers = workers
+        self.tile_size = tileSize
+        self.tile_cache_size = tile_cache_size
+        self.max_cells = max_cells
+        self.results = LRUCache(result_cache_size)
+        self.executor : ProcessPoolExecutor | None = None
+        self._pending : dict[tuple, asyncio.Future] = {}
+        self._latencies : deque[float] = deque(maxlen=1000)
+        self._requests = 0
+        self._errors = 0
+        self._coalesced = 0
+        self._tile_hits = 0
+        self._tile_misses = 0
+        self._started = time.perf_counter()
+
+    '''
+        Загружает контуры, строит полигоны высот и запускает пул процессов.
+    '''
+    def start(self):
+        polygons, _ = self.terrain.layer(self.crs)
+        buffered = shapely.buffer(polygons.geometry.to_numpy(), 1, quad_segs=16)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(shapely.to_wkb(buffered), polygons['elevation'].to_numpy(), self.tile_size, self.tile_cache_size),
+        )
+
+    '''
+        Запускает HTTP сервер на host:port и обслуживает запросы до остановки.
+    '''
+    async def serve(self, host: str = '127.0.0.1', port: int = 8080):
+        if self.executor is None:
+            self.start()
+        assert self.executor is not None
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving heightmaps on http://{host}:{port}', flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+    '''
+        Возвращает карту высот сетки с указанными параметрами из кэша или вычисляет её в пуле процессов.
+    '''
+    async def heightmap(self, leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int) -> tuple[np.ndarray, GridGeoreference]:
+        georeference = GridGeoreference(leftBottom, stepSize, columnCount, rowCount, self.crs)
+        key = (leftBottom, stepSize, columnCount, rowCount)
+        heights = self.results.get(key)
+        if heights is not None:
+            return heights, georeference
+
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, _sample_in_worker, leftBottom, stepSize, columnCount, rowCount)
+            self._pending[key] = future
+            future.add_done_callback(functools.partial(self._store_result, key))
+        else:
+            self._coalesced += 1
+        heights, _, _ = await asyncio.shield(future)
+        return heights, georeference
+
+    def _store_result(self, key: tuple, future: asyncio.Future):
+        del self._pending[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        heights, tile_hits, tile_misses = future.result()
+        #Закэшированный массив отдаётся многим запросам, поэтому запрещаем его изменение
+        heights.flags.writeable = False
+        self.results.put(key, heights, heights.nbytes)
+        self._tile_hits += tile_hits
+        self._tile_misses += tile_misses
+
+    '''
+        Статистика сервиса: число запросов и ошибок, задержки последних запросов карт высот (в миллисекундах) и состояние кэшей.
+    '''
+    def stats(self) -> dict:
+        latencies = np.array(self._latencies) * 1000
+        return {
+            'uptime_s': time.perf_counter() - self._started,
+            'requests': self._requests,
+            'errors': self._errors,
+            'in_flight': len(self._pending),
+            'coalesced': self._coalesced,
+            'latency_ms': {
+                'count': len(latencies),
+                'mean': float(latencies.mean()) if len(latencies) else None,
+                'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p95': float(np.percentile(latencies, 95)) if len(latencies) else None,
+                'max': float(latencies.max()) if len(latencies) else None,
+            },
+            'result_cache': self.results.stats(),
+            'tile_cache': {
+                'hits': self._tile_hits,
+                'misses': self._tile_misses,
+                'hit_rate': _hit_rate(self._tile_hits, self._tile_misses),
+            },
+        }
+
+    '''
+        Обрабатывает одно HTTP соединение: один запрос, один ответ.
+    '''
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            #Заголовки запроса не используются, но должны быть прочитаны до ответа
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            status, content_type, body, headers = await self.route(request_line)
+            writer.write(_response(status, content_type, body, headers))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    '''
+        Выполняет запрос request_line ("GET /path?query HTTP/1.1"). Возвращает статус, тип содержимого, тело и дополнительные заголовки ответа.
+    '''
+    async def route(self, request_line: str) -> tuple[str, str, bytes, dict[str, str]]:
+        parts = request_line.split(' ')
+        if len(parts) != 3:
+            return _error('400 Bad Request', 'Malformed request line.')
+        method, target, _ = parts
+        url = urlsplit(target)
+        if url.path not in ('/heightmap', '/stats'):
+            return _error('404 Not Found', f'Unknown path `{url.path}`.')
+        if method != 'GET':
+            return _error('405 Method Not Allowed', f'Method `{method}` is not allowed.')
+        if url.path == '/stats':
+            return '200 OK', 'application/json', json.dumps(self.stats()).encode('utf-8'), {}
+
+        started = time.perf_counter()
+        self._requests += 1
+        try:
+            leftBottom, stepSize, columnCount, rowCount, format = self.parse_query(url.query)
+            heights, georeference = await self.heightmap(leftBottom, stepSize, columnCount, rowCount)
+            #Форматирование большой сетки занимает заметное время, поэтому тоже выполняется вне цикла событий
+            body = await asyncio.get_running_loop().run_in_executor(None, encode_height_map, heights, georeference, format)
+        except (KeyError, ValueError) as error:
+            self._errors += 1
+            return _error('400 Bad Request', str(error.args[0]) if error.args else str(error))
+        except Exception as error:
+            self._errors += 1
+            return _error('500 Internal Server Error', f'{type(error).__name__}: {error}')
+        self._latencies.append(time.perf_counter() - started)
+        return '200 OK', SERVICE_FORMATS[format], body, {'X-Georeference': json.dumps(georeference._asdict())}
+
+    '''
+        Разбирает параметры запроса /heightmap. Возвращает левый нижний угол сетки в crs, шаг, число столбцов и строк и формат ответа.
+        Сетка начинается в левом нижнем углу bbox и должна целиком лежать в загруженном регионе, иначе возвращается ошибка 400.
+    '''
+    def parse_query(self, query: str) -> tuple[tuple[int, int], int, int, int, str]:
+        params = {name: values[-1] for name, values in parse_qs(query).items()}
+        for name in ('bbox', 'step_size', 'rows', 'cols'):
+            if name not in params:
+                raise KeyError(f'Missing query parameter `{name}`.')
+        bbox = [float(value) for value in params['bbox'].split(',')]
+        if len(bbox) != 4:
+            raise ValueError('bbox should be `min_lon,min_lat,max_lon,max_lat`.')
+        region = (*self.terrain.left_bottom, *self.terrain.right_top)
+        if bbox[0] < region[0] or bbox[1] < region[1] or bbox[2] > region[2] or bbox[3] > region[3]:
+            raise ValueError(f'bbox {bbox} is outside the loaded region {list(region)}.')
+        stepSize, rowCount, columnCount = int(params['step_size']), int(params['rows']), int(params['cols'])
+        if stepSize < 1:
+            raise ValueError('step_size should be greater than 0')
+        elif rowCount < 1:
+            raise ValueError('rows should be greater than 0')
+        elif columnCount < 1:
+            raise ValueError('cols should be greater than 0')
+        elif rowCount*columnCount > self.max_cells:
+            raise ValueError(f'The grid has more than {self.max_cells} cells.')
+        format = params.get('format', 'asc')
+        if format not in SERVICE_FORMATS:
+            raise ValueError(f'Unknown output format `{format}`.')
+        projected = wgs84_point_to_crs((bbox[0], bbox[1]), self.crs)
+        leftBottom = (int(projected[0]), int(projected[1]))
+        #Сетка задаётся левым нижним углом bbox, шагом и размерами, поэтому в загруженном регионе должна лежать она сама, а не только bbox.
+        #Запас -1 метр учитывает округление угла сетки до целых метров вниз.
+        grid_left_bottom, grid_right_top = grid_bounds_wgs84(leftBottom, stepSize, columnCount, rowCount, self.crs, -1)
+        if grid_left_bottom[0] < region[0] or grid_left_bottom[1] < region[1] or grid_right_top[0] > region[2] or grid_right_top[1] > region[3]:
+            raise ValueError(f'The grid {[*grid_left_bottom, *grid_right_top]} is outside the loaded region {list(region)}.')
+        return leftBottom, stepSize, columnCount, rowCount, format
+
+'''
+    Кодирует карту высот в тело ответа формата format: ESRI ASCII grid ('asc') или .npy с float32 ('npy').
+'''
+def encode_height_map(heights: np.ndarray, georeference: GridGeoreference, format: str) -> bytes:
+    if format == 'asc':
+        text = io.StringIO()
+        dump_ascii_grid(text, heights, georeference)
+        return text.getvalue().encode('utf-8')
+    elif format == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, heights.astype('<f4'))
+        return buffer.getvalue()
+    raise ValueError(f'Unknown output format `{format}`.')
+
+def _response(status: str, content_type: str, body: bytes, headers: dict[str, str]) -> bytes:
+    lines = [f'HTTP/1.1 {status}', f'Content-Type: {content_type}', f'Content-Length: {len(body)}', 'Connection: close']
+    lines += [f'{name}: {value}' for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+def _error(status: str, message: str) -> tuple[str, str, bytes, dict[str, str]]:
+    return status, 'application/json', json.dumps({'error': message}).encode('utf-8'), {}
+
+def _hit_rate(hits: int, misses: int) -> float | None:
+    return hits / (hits + misses) if hits + misses else None
@@ -0,0 +1,128 @@
+import numpy as np
+import pyogrio
+import pyproj
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import NamedTuple
+from modules import profiling
+from modules.contours import contours_to_polygons
+from modules.processing import GridGeoreference, get_transformer, load_geojson, validate_data, project_geometry
+from modules.rasterization import rasterize_height_map
+
+'''
+    Тайл сетки высот: прямоугольный блок строк и столбцов итогового массива (строка 0 - верхняя строка сетки).
+'''
+class GridTile(NamedTuple):
+    row_start: int
+    row_end: int
+    column_start: int
+    column_end: int
+
+'''
+    Разбивает сетку columnCount x rowCount на тайлы размером не более tileSize x tileSize ячеек.
+'''
+def split_grid(columnCount: int, rowCount: int, tileSize: int) -> list[GridTile]:
+    if tileSize < 1:
+        raise ValueError('tileSize should be greater than 0')
+    return [GridTile(row, min(row + tileSize, rowCount), column, min(column + tileSize, columnCount))
+            for row in range(0, rowCount, tileSize)
+            for column in range(0, columnCount, tileSize)]
+
+'''
+    Возвращает геопривязку тайла tile сетки georeference.
+'''
+def tile_georeference(georeference: GridGeoreference, tile: GridTile) -> GridGeoreference:
+    step = georeference.step_size
+    return GridGeoreference(
+        (georeference.left_bottom[0] + tile.column_start*step, georeference.left_bottom[1] + (georeference.row_count - tile.row_end)*step),
+        step,
+        tile.column_end - tile.column_start,
+        tile.row_end - tile.row_start,
+        georeference.crs,
+    )
+
+'''
+    Строит карту высот по частям: сетка разбивается на тайлы, и каждый тайл обрабатывается в отдельном процессе
+    (загрузка фитч тайла, валидация, проецирование, построение полигонов и растеризация), после чего тайлы сшиваются в один массив.
+    Фитчи отбираются так же, как при обработке всей области одним процессом (load_geojson с регионом left_bottom/right_top),
+    а каждый процесс загружает только те из них, ограничивающий прямоугольник которых пересекает его тайл, расширенный на halo.
+    Поэтому для непересекающихся контуров результат совпадает с результатом rasterize_height_map для всей области,
+    а пиковая память процесса зависит от размера тайла. Если контуры пересекаются (например, дублированные или перерисованные линии
+    одной высоты), результат у границ тайлов может отличаться: объединение колец одной высоты и проверки вложенности в тайле
+    не видят пересекающий кольцо контур, ограничивающий прямоугольник которого не достаёт до тайла (см. select_tile_features).
+    Аргументы:
+        path : str - путь до файла с контурами.
+        left_bottom : tuple[float, float] - левый нижний угол загружаемого региона в WGS84.
+        right_top : tuple[float, float] - правый верхний угол загружаемого региона в WGS84.
+        leftBottom : tuple[int, int] - левый нижний угол сетки в crs.
+        stepSize : int - шаг сетки.
+        columnCount : int - число столбцов сетки.
+        rowCount : int - число строк сетки.
+        crs : str - система координат сетки.
+        tileSize : int - размер стороны тайла в ячейках.
+        halo : float - запас вокруг тайла (в единицах crs) при отборе фитч. Должен превышать 1 метр, на который расширяются полигоны при сэмплировании.
+        workers : int | None - число процессов (по умолчанию - число ядер).
+    Возвращает:
+        tuple[np.ndarray, GridGeoreference] - массив высот и его геопривязка, как у rasterize_height_map.
+'''
+@profiling.stage('generate_height_map_tiled', lambda result: {'cells': result[0].size, 'nodata_cells': int(np.isnan(result[0]).sum())})
+def generate_height_map_tiled(path: str, left_bottom: tuple[float, float], right_top: tuple[float, float], leftBottom: tuple[int, int], stepSize: int, columnCount: int, rowCount: int, crs: str, tileSize: int = 512, halo: float = 10, workers: int | None = None) -> tuple[np.ndarray, GridGeoreference]:
+    if columnCount < 1:
+        raise ValueError('columnCount should be greater than 0')
+    elif rowCount < 1:
+        raise ValueError('rowCount should be greater than 0')
+    elif stepSize < 1:
+        raise ValueError('stepSize should be greater than 0')
+    elif halo <= 1:
+        raise ValueError('halo should be greater than 1')
+
+    georeference = GridGeoreference((leftBottom[0], leftBottom[1]), stepSize, columnCount, rowCount, crs)
+    heights = np.full((rowCount, columnCount), np.nan, dtype=np.float64)
+
+    #Идентификаторы и ограничивающие прямоугольники фитч, которые загрузил бы load_geojson для всей области
+    fids, bounds = pyogrio.read_bounds(path, bbox=(*left_bottom, *right_top))
+    to_wgs84 = get_transformer(crs, 'EPSG:4326')
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for tile in split_grid(columnCount, rowCount, tileSize):
+            tile_georef = tile_georeference(georeference, tile)
+            tile_fids = select_tile_features(fids, bounds, to_wgs84, tile_georef, halo)
+            if not tile_fids:
+                continue
+            futures[executor.submit(sample_tile, path, tile_fids, tile_georef)] = tile
+        profiling.count('tiles', len(futures))
+
+        for future in as_completed(futures):
+            tile = futures[future]
+            heights[tile.row_start:tile.row_end, tile.column_start:tile.column_end] = future.result()
+
+    return heights, georeference
+
+'''
+    Отбирает фитчи, ограничивающий прямоугольник которых (bounds из pyogrio.read_bounds, в WGS84) пересекает область центров ячеек
+    тайла georeference, расширенную на halo и переведённую в WGS84 преобразованием to_wgs84. Возвращает идентификаторы фитч из fids.
+    Отбор только по ограничивающему прямоугольнику достаточен для непересекающихся контуров: тогда все кольца, от которых зависят полигоны
+    в тайле (сами кольца и охватывающие их), пересекают тайл. Контуры, пересекающие отобранные кольца вне тайла, не отбираются.
+'''
+def select_tile_features(fids: np.ndarray, bounds: np.ndarray, to_wgs84: pyproj.Transformer, georeference: GridGeoreference, halo: float) -> list[int]:
+    half = georeference.step_size//2
+    region = to_wgs84.transform_bounds(
+        georeference.left_bottom[0] + half - halo,
+        georeference.left_bottom[1] + half - halo,
+        georeference.left_bottom[0] + half + (georeference.column_count - 1)*georeference.step_size + halo,
+        georeference.left_bottom[1] + half + (georeference.row_count - 1)*georeference.step_size + halo,
+        densify_pts=21,
+    )
+    selected = (bounds[0] <= region[2]) & (bounds[2] >= region[0]) & (bounds[1] <= region[3]) & (bounds[3] >= region[1])
+    return fids[selected].tolist()
+
+'''
+    Обрабатывает один тайл: загружает указанные фитчи, строит по ним полигоны и растеризует их в сетку тайла.
+    Выполняется в дочернем процессе generate_height_map_tiled.
+'''
+def sample_tile(path: str, fids: list[int], georeference: GridGeoreference) -> np.ndarray:
+    df = load_geojson(path, fids=fids)
+    validate_data(df)
+    df_polygons = contours_to_polygons(project_geometry(df, georeference.crs))
+    heights, _ = rasterize_height_map(df_polygons, georeference.left_bottom, georeference.step_size, georeference.column_count, georeference.row_count, georeference.crs)
+    return heights
@@ -0,0 +1,106 @@
+import numpy as np
+import os
+from typing import Final, TextIO
+from modules import profiling
+from modules.processing import GridGeoreference, NODATA_VALUE
+
+#Расширения файлов для поддерживаемых форматов вывода
+OUTPUT_EXTENSIONS : Final[dict[str, str]] = {'asc': '.txt', 'flt': '.flt', 'npy': '.npy'}
+
+'''
+    Записывает карту высот в ESRI ASCII grid.
+    Строки массива форматируются блоками по chunk_rows строк с фиксированным форматом числа fmt, а nan заменяются на nodata.
+    Аргументы:
+        path : str - путь до создаваемого файла.
+        heights : np.ndarray - массив высот формы (row_count, column_count), строка 0 - верхняя строка сетки.
+        georeference : GridGeoreference - геопривязка массива.
+        nodata : float - значение, записываемое вместо nan.
+        fmt : str - формат одного значения (в стиле оператора %).
+        chunk_rows : int - число строк, форматируемых за раз.
+'''
+def write_ascii_grid(path: str, heights: np.ndarray, georeference: GridGeoreference, nodata: float = NODATA_VALUE, fmt: str = '%.2f', chunk_rows: int = 256):
+    with open(path, 'w', encoding='utf-8') as file:
+        dump_ascii_grid(file, heights, georeference, nodata, fmt, chunk_rows)
+
+'''
+    Записывает карту высот в ESRI ASCII grid в открытый текстовый поток file (аргументы - как у write_ascii_grid).
+'''
+def dump_ascii_grid(file: TextIO, heights: np.ndarray, georeference: GridGeoreference, nodata: float = NODATA_VALUE, fmt: str = '%.2f', chunk_rows: int = 256):
+    _check_shape(heights, georeference)
+    row_format = ' '.join([fmt]*georeference.column_count) + '\n'
+    file.write(f'ncols {georeference.column_count}\n')
+    file.write(f'nrows {georeference.row_count}\n')
+    file.write(f'xllcorner {georeference.left_bottom[0]}\n')
+    file.write(f'yllcorner {georeference.left_bottom[1]}\n')
+    file.write(f'cellsize {georeference.step_size}\n')
+    file.write(f'NODATA_value {nodata:g}\n')
+    for start in range(0, georeference.row_count, chunk_rows):
+        chunk = _fill_nodata(heights[start:start + chunk_rows], nodata)
+        file.write(''.join(row_format % tuple(row) for row in chunk.tolist()))
+
+'''
+    Записывает карту высот в бинарный ESRI float grid: сырые float32 little-endian (path, обычно .flt),
+    и заголовок .hdr с размерами и геопривязкой (его читает и GDAL, поэтому отдельный world file не нужен). nan заменяются на nodata.
+'''
+def write_float32_grid(path: str, heights: np.ndarray, georeference: GridGeoreference, nodata: float = NODATA_VALUE, chunk_rows: int = 1024):
+    _check_shape(heights, georeference)
+    with open(path, 'wb') as file:
+        for start in range(0, georeference.row_count, chunk_rows):
+            _fill_nodata(heights[start:start + chunk_rows], nodata).astype('<f4').tofile(file)
+
+    stem = os.path.splitext(path)[0]
+    with open(stem + '.hdr', 'w', encoding='utf-8') as file:
+        file.write(f'ncols {georeference.column_count}\n')
+        file.write(f'nrows {georeference.row_count}\n')
+        file.write(f'xllcorner {georeference.left_bottom[0]}\n')
+        file.write(f'yllcorner {georeference.left_bottom[1]}\n')
+        file.write(f'cellsize {georeference.step_size}\n')
+        file.write(f'NODATA_value {nodata:g}\n')
+        file.write('byteorder LSBFIRST\n')
+
+'''
+    Записывает карту высот в .npy (float32) через memmap, блоками по chunk_rows строк, и world file рядом с ним
+    (имя по общему правилу - расширение файла и буква w: heightmap.npy -> heightmap.npyw).
+    Значения nan сохраняются как есть. Файл можно открыть без разбора текста: np.load(path, mmap_mode='r').
+'''
+def write_npy(path: str, heights: np.ndarray, georeference: GridGeoreference, chunk_rows: int = 1024):
+    _check_shape(heights, georeference)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype='<f4', shape=heights.shape)
+    for start in range(0, georeference.row_count, chunk_rows):
+        out[start:start + chunk_rows] = heights[start:start + chunk_rows]
+    out.flush()
+    del out
+    write_world_file(path + 'w', georeference)
+
+'''
+    Записывает world file: размер ячейки по x, два коэффициента поворота, размер ячейки по y (отрицательный)
+    и координаты центра левой верхней ячейки.
+'''
+def write_world_file(path: str, georeference: GridGeoreference):
+    step = georeference.step_size
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write(f'{step}\n0\n0\n{-step}\n')
+        file.write(f'{georeference.left_bottom[0] + step/2}\n')
+        file.write(f'{georeference.left_bottom[1] + georeference.row_count*step - step/2}\n')
+
+'''
+    Записывает карту высот в формате format ('asc', 'flt' или 'npy').
+'''
+@profiling.stage('write_height_map')
+def write_height_map(path: str, heights: np.ndarray, georeference: GridGeoreference, format: str = 'asc'):
+    profiling.count('cells', heights.size)
+    if format == 'asc':
+        write_ascii_grid(path, heights, georeference)
+    elif format == 'flt':
+        write_float32_grid(path, heights, georeference)
+    elif format == 'npy':
+        write_npy(path, heights, georeference)
+    else:
+        raise ValueError(f'Unknown output format `{format}`.')
+
+def _fill_nodata(heights: np.ndarray, nodata: float) -> np.ndarray:
+    return np.where(np.isnan(heights), nodata, heights)
+
+def _check_shape(heights: np.ndarray, georeference: GridGeoreference):
+    if heights.shape != (georeference.row_count, georeference.column_count):
+        raise ValueError(f'Height map shape {heights.shape} does not match the georeference ({georeference.row_count}, {georeference.column_count}).')
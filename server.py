@@ -0,0 +1,39 @@
+# Локальный сервис карт высот: контуры загружаются и преобразуются в полигоны один раз, после чего
+# сервис отвечает на запросы карт высот для окон внутри загруженного региона.
+# Использование:
+#   python server.py --source lipetsk_high.geojson --region 39.444032 52.466341 39.829939 52.683001
+# Запросы:
+#   curl "http://127.0.0.1:8080/heightmap?bbox=39.444032,52.466341,39.829939,52.683001&step_size=200&rows=101&cols=130"
+#   curl "http://127.0.0.1:8080/heightmap?bbox=...&step_size=200&rows=101&cols=130&format=npy" -o heightmap.npy
+#   curl "http://127.0.0.1:8080/stats"
+# Левый нижний угол bbox задаёт левый нижний угол сетки (как left_bottom в main.py), геопривязка ответа - в заголовке X-Georeference.
+
+import argparse
+import asyncio
+from modules.cache import ContourCache
+from modules.jobs import SharedTerrain
+from modules.processing import MSK_48_CRS
+from modules.service import HeightMapService
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve heightmaps for windows of one preloaded contour region.')
+    parser.add_argument('--source', required=True, help='GeoJSON file with contour lines')
+    parser.add_argument('--region', required=True, type=float, nargs=4, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'), help='region to load, in WGS84')
+    parser.add_argument('--crs', default=MSK_48_CRS, help='coordinate system of the served grids')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, help='number of sampling processes (default: number of cores)')
+    parser.add_argument('--tile-size', type=int, default=10000, help='side of a cached polygon tile, in CRS units')
+    parser.add_argument('--result-cache-mb', type=int, default=256, help='size limit of the heightmap cache')
+    parser.add_argument('--tile-cache-mb', type=int, default=256, help='size limit of the polygon tile cache of every process')
+    parser.add_argument('--cache-dir', help='directory of the projected contours and polygons cache')
+    parser.add_argument('--batch-size', type=int, help='read the source in streamed batches of this many features')
+    args = parser.parse_args()
+
+    cache = ContourCache(args.cache_dir) if args.cache_dir else None
+    terrain = SharedTerrain(args.source, tuple(args.region[:2]), tuple(args.region[2:]), cache, args.batch_size)
+    service = HeightMapService(terrain, args.crs, args.workers, args.tile_size, args.result_cache_mb*1024**2, args.tile_cache_mb*1024**2)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
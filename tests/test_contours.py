@@ -0,0 +1,19 @@
+import geopandas
+import shapely
+from modules.contours import contours_to_polygons
+
+'''
+    Кольцо 150 содержит кольцо 120, а оно - кольцо 140. Из полигона 150 вычитается только ближайший вложенный полигон с меньшей высотой (120),
+    поэтому кольцо между 100 и 200 метрами от центра принадлежит высоте 120, а не 150.
+'''
+def test_higher_ring_inside_lower_hole():
+    rings = [shapely.Point(0, 0).buffer(radius).exterior for radius in (300, 200, 100)]
+    df = geopandas.GeoDataFrame({'elevation': [150, 120, 140]}, geometry=rings, crs='EPSG:3857')
+
+    polygons = contours_to_polygons(df).set_index('elevation').geometry
+    annulus = shapely.Point(0, 0).buffer(200).difference(shapely.Point(0, 0).buffer(100))
+
+    assert not polygons[150].intersects(shapely.Point(150, 0))
+    assert polygons[150].symmetric_difference(shapely.Point(0, 0).buffer(300).difference(shapely.Point(0, 0).buffer(200))).area < 1e-6
+    assert polygons[120].contains(annulus.representative_point())
+    assert polygons[140].contains(shapely.Point(0, 0))
@@ -0,0 +1,23 @@
+import geopandas
+import numpy as np
+import shapely
+from modules.contours import contours_to_polygons
+from modules.processing import MSK_48_CRS, clip_and_project, grid_clip_bounds, project_geometry, wgs84_point_to_crs
+from modules.rasterization import rasterize_height_map
+
+'''
+    Впадина (кольцо 100 внутри кольца 110) пересекает южную сторону области сетки. После проецирования эта сторона искривляется,
+    поэтому при обрезке только в WGS84 часть кольца 100 переставала лежать внутри части кольца 110 и впадина заполнялась высотой 110.
+'''
+def test_clipped_depression_matches_unclipped():
+    centre = (38.5, 52.6)
+    rings = [shapely.Point(*centre).buffer(radius, quad_segs=64).exterior for radius in (0.5, 0.4)]
+    df = geopandas.GeoDataFrame({'elevation': [110.0, 100.0]}, geometry=rings, crs='EPSG:4326')
+    x, y = wgs84_point_to_crs(centre, MSK_48_CRS)
+    grid = ((int(x) - 30000, int(y) + 20000), 1000, 60, 30, MSK_48_CRS)
+
+    expected, _ = rasterize_height_map(contours_to_polygons(project_geometry(df, MSK_48_CRS)), *grid)
+    actual, _ = rasterize_height_map(contours_to_polygons(clip_and_project(df, grid_clip_bounds(*grid, 0), MSK_48_CRS)), *grid)
+
+    assert (expected == 100).any()
+    np.testing.assert_array_equal(actual, expected)
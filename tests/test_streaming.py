@@ -0,0 +1,25 @@
+import geopandas
+import numpy as np
+import pandas
+import shapely
+from benchmarks.synthetic import nested_hills
+from modules.processing import load_geojson
+from modules.streaming import iter_geojson_batches
+
+'''
+    Файл читается кусками разного размера, поэтому граница куска попадает в разные места текста, в том числе сразу после запятой
+    между фитчами (раньше пробелы после неё, не попавшие в буфер, ломали разбор). Результат должен совпадать с load_geojson с регионом и без него.
+'''
+def test_streamed_batches_match_load_geojson_for_any_chunk_size(tmp_path):
+    path = str(tmp_path / 'hills.geojson')
+    nested_hills(4).to_crs('EPSG:4326').to_file(path, driver='GeoJSON')
+    min_x, min_y, max_x, max_y = load_geojson(path).total_bounds
+    regions = [(None, None), ((min_x, min_y), ((min_x + max_x)/2, (min_y + max_y)/2))]
+
+    for left_bottom, right_top in regions:
+        expected = load_geojson(path, left_bottom, right_top)
+        for chunk_size in range(300, 700):
+            actual = geopandas.GeoDataFrame(pandas.concat(iter_geojson_batches(path, left_bottom, right_top, 32, chunk_size)))
+            assert len(actual) == len(expected), chunk_size
+            np.testing.assert_array_equal(actual['elevation'].to_numpy(), expected['elevation'].to_numpy())
+            assert shapely.equals_exact(actual.geometry.to_numpy(), expected.geometry.to_numpy(), 0).all(), chunk_size
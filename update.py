@@ -0,0 +1,30 @@
+# Обновление карты высот после небольших правок исходного файла с контурами.
+# Карта высот должна быть построена main.py с `incremental = True`, который сохраняет рядом с ней манифест фитч.
+# Использование:
+#   python update.py heightmap_200m_130c_101r.txt.manifest.npz [--source lipetsk_high_edited.geojson]
+# Пересчитываются только ячейки, лежащие рядом с добавленными, удалёнными или изменёнными фитчами,
+# и записываются в файл карты высот на месте. Выводится число пересчитанных ячеек и сэкономленное время.
+
+import argparse
+from modules import profiling
+from modules.incremental import update_height_map
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update a heightmap in place after edits of its contour file.')
+    parser.add_argument('manifest', help='manifest written next to the heightmap by main.py')
+    parser.add_argument('--source', help='edited contour file (default: the file recorded in the manifest)')
+    parser.add_argument('--halo', type=float, default=10, help='margin around changed features, in CRS units')
+    parser.add_argument('--batch-size', type=int, default=10000, help='features per batch when reading the source')
+    parser.add_argument('--profile', metavar='REPORT', help='write a per-stage JSON metrics report to this path')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiling.start()
+
+    report = update_height_map(args.manifest, args.source, args.halo, args.batch_size)
+    print(f'Features: +{report["added_features"]} -{report["removed_features"]}, windows: {report["windows"]}')
+    print(f'Touched cells: {report["touched_cells"]} of {report["total_cells"]} ({report["touched_cells"]/report["total_cells"]:.2%})')
+    print(f'Update: {report["elapsed_s"]:.2f}s, full run: {report["full_run_s"]:.2f}s, saved: {report["saved_s"]:.2f}s')
+
+    if args.profile:
+        profiling.stop(args.profile)